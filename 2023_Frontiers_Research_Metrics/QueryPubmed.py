@@ -1,82 +1,846 @@
 
 from Bio import Entrez
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+import threading
+import random
+import time
+import io
+import json
+import os
+import sqlite3
+import unicodedata
+from read_FilteredPMIDs import get_journal_pmids
+from read_JournalRegistry import get_journal_registry
 
 Entrez.email = ''    # USER WOULD NEED TO INPUT THEIR OWN EMAIL
 my_key = ''         # USER WOULD NEED TO INPUT THEIR OWN PUBMED API KEY
 
+selfref_columns = ['Journal', 'Main Article PubmedID', 'Main Article Combinednames', 'All-Author # of Self-References', 'All-Author % Self-References', 'Max Self-Referencing Author', '# of Self-References', 'Total References', '% Self-References', 'Initial-Level All-Author # of Self-References', 'Initial-Level All-Author % Self-References', 'Initial-Level Max Self-Referencing Author', 'Initial-Level # of Self-References', 'Initial-Level % Self-References']
+
+refs_badrequests_columns = ['MainAritcle PubmedID', 'RefArticle PubmedID']
+
+# LETTERS THAT DO NOT DECOMPOSE INTO A BASE LETTER + ACCENT UNDER NFKD, MAPPED TO THEIR USUAL ASCII SPELLING
+folded_letters = str.maketrans({'ø':'o', 'ł':'l', 'đ':'d', 'ð':'d', 'ħ':'h', 'ı':'i', 'ŀ':'l', 'þ':'th', 'æ':'ae', 'œ':'oe'})
+
 def main():
 
-    journals = ['PLoS Pathog', 'PLoS Biol', 'PLoS Genet', 'PLoS Comput Biol', 'PLoS Med', 'Cell', 'Nature', 'Science', 'Genetics', 'Bioinformatics', 'BMC Med', 'mBio', 'J Cell Biol', 'Curr Biol', 'Mol Cell Biol']
-    journal_args = ['PlosPath', 'PlosBiol', 'PlosGenet', 'PlosCompBiol', 'PlosMed', 'Cell', 'Nature', 'Science', 'Genetics', 'Bioinformatics', 'BMCmed', 'mBio', 'JCellBiol', 'CurrBiol', 'MCB']
-    journal_df = {journal_arg:journals[i] for i, journal_arg in enumerate(journal_args)}
-    
+    # JOURNALS ARE READ FROM THE JOURNAL REGISTRY (SEE read_JournalRegistry.py). SET include_all_journals TO True TO ALSO QUERY
+    # EVERY OTHER JOURNAL IN THE FILTERED PMID LIST, OR LIST JOURNAL KEYS IN journals_to_query TO ONLY QUERY THOSE JOURNALS.
+    registry_file = 'Journal_Registry.tsv'
+    include_all_journals = False
+    journals_to_query = None
+    registry = get_journal_registry(registry_file, include_all_journals)
+    journal_args = [entry['Journal'] for entry in registry if journals_to_query is None or entry['Journal'] in journals_to_query]
+    journal_df = {entry['Journal']:entry['PubMed Journal Title'] for entry in registry}
+
+    # E-UTILITIES ENDPOINT. SET TO A LOCAL MOCK SERVER (e.g. 'http://127.0.0.1:8000/') FOR TESTING WITHOUT QUERYING NCBI
+    base_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+
+    # NCBI PERMITS 10 REQUESTS/SECOND WITH AN API KEY AND 3 REQUESTS/SECOND WITHOUT ONE. num_workers IS THE MAXIMUM NUMBER OF REQUESTS IN FLIGHT.
+    requests_per_second = 10 if my_key else 3
+    num_workers = 10
+    main_articles_per_chunk = 200
+
+    # AUTHOR LISTS ARE FETCHED FOR UP TO pmids_per_request ARTICLES IN EACH efetch REQUEST, AND REFERENCE LISTS FOR UP TO
+    # links_per_request MAIN ARTICLES IN EACH elink REQUEST
+    pmids_per_request = 200
+    links_per_request = 200
+
+    # FAILED REQUESTS (CONNECTION ERRORS, HTTP 429 AND 5xx) ARE RETRIED WITH EXPONENTIAL BACKOFF
+    max_tries = 10
+    backoff_base = 0.5
+    backoff_max = 60
+
+    # PERSISTENT CACHE OF PARSED AUTHOR LISTS AND REFERENCE LISTS, SHARED ACROSS JOURNALS AND RUNS. WITH cache_file SET TO None,
+    # THE CACHE IS ONLY KEPT IN MEMORY FOR THE CURRENT RUN SO THAT EACH DISTINCT REFERENCE IS STILL FETCHED ONLY ONCE.
+    cache_file = 'Pubmed_QueryCache.sqlite'
+    cache_ttl_days = 90
+    cache_max_entries = 5000000     # PER TABLE. OLDEST ENTRIES ARE EVICTED FIRST.
+
+    eutils = make_eutils_session(base_url, requests_per_second, max_tries, backoff_base, backoff_max)
+    cache = open_cache(cache_file if cache_file else ':memory:', cache_ttl_days, cache_max_entries)
+    pool = ThreadPoolExecutor(max_workers=num_workers)
+
+    # resume: CONTINUE AN INTERRUPTED CRAWL FROM ITS CHECKPOINT JOURNAL, APPENDING TO THE EXISTING OUTPUT FILES
+    # replay_failed: ONLY RE-QUERY THE ENTRIES LISTED IN THE FailedQueries FILES FROM AN EARLIER RUN
+    resume = False
+    replay_failed = False
+
+    # SELF-REFERENCE COUNTS ARE CALCULATED AS SOON AS EACH MAIN ARTICLE'S REFERENCES ARE RESOLVED AND COMBINED INTO TableS1 (USED BY
+    # plot_SelfReferencingStatistics.py). THE VERY LARGE PER-CITATION AUTHOR SEARCH FILES ARE ONLY WRITTEN IF write_author_search IS True.
+    write_author_search = True
+    selfref_table_file = 'TableS1_SelfReferencingRate_Estimates.tsv'
+
     for journal_arg in journal_args:
         journal = journal_df[journal_arg]
-        
-        max_tries = 10
+        files = get_journal_files(journal_arg, write_author_search)
+
+        if replay_failed:
+            replay_failed_queries(pool, eutils, cache, journal_arg, files, main_articles_per_chunk, pmids_per_request, links_per_request)
+            continue
 
         pmids = get_pubmed_ids(journal)
         all_pmids = sorted([x for x in pmids])
 
-        main_badrequests_output = open('FailedQueries_for_MainArticle_PubmedIDs_' + journal_arg + '.txt', 'w')
-        
-        refs_badrequests_output = open('FailedQueries_for_RefArticle_PubmedIDs_' + journal_arg + '.tsv', 'w')
-        refs_badrequests_output.write('MainAritcle PubmedID\tRefArticle PubmedID\n')
-        
-        output = open('Pubmed_AuthorSearch_' + journal_arg + '.tsv', 'w')
-        output.write('\t'.join(['Main Article PubmedID', 'Main Article Combinednames', 'Main Article Lastnames', 'Main Article Firstnames', 'Main Article Initials', 'Main Dictionary Contained Firstname Key?', 'Cited Article PubmedID', 'Cited Article Combinednames', 'Cited Article Lastnames', 'Cited Article Firstnames', 'Cited Article Initials', 'Cited Dictionary Contained Firstname Key?']) + '\n')
-        for main_pmid in tqdm(all_pmids):
-            successful_main = False
-            tries = 0
-            while not successful_main and tries < max_tries:
-                try:
-                    if tries > 0:
-                        print(tries, main_pmid)
-                    tries += 1
-                    main_art_combinednames, main_art_lastnames, main_art_firstnames, main_art_initials, main_art_containedfirstnames = get_authorlist(main_pmid)
-                    
-                    results = Entrez.read(Entrez.elink(db="pubmed", LinkName="pubmed_pubmed_refs", from_uid=main_pmid, api_key=my_key))
-                    id_list = [link["Id"] for link in results[0]["LinkSetDb"][0]["Link"]]
-                    successful_main = True
-
-                except:
-                    continue
-                    
-            if tries == max_tries:
-                main_badrequests_output.write(main_pmid + '\n')
+        output_files = [files[key] for key in ('output', 'main_badrequests', 'refs_badrequests', 'selfrefs') if files[key]]
+        completed_pmids = None
+        if resume and get_header(files['selfrefs']) == selfref_columns:    # FILES WITH AN OLDER TableS1 LAYOUT ARE RESTARTED
+            completed_pmids = load_checkpoint(files['checkpoint'], output_files)
+
+        if completed_pmids is None:
+            completed_pmids = set()
+            main_badrequests_output = open(files['main_badrequests'], 'w')
+
+            refs_badrequests_output = open(files['refs_badrequests'], 'w')
+            refs_badrequests_output.write('\t'.join(refs_badrequests_columns) + '\n')
+
+            output = None
+            if files['output']:
+                output = open(files['output'], 'w')
+                output.write('\t'.join(['Main Article PubmedID', 'Main Article Combinednames', 'Main Article Lastnames', 'Main Article Firstnames', 'Main Article Initials', 'Main Dictionary Contained Firstname Key?', 'Cited Article PubmedID', 'Cited Article Combinednames', 'Cited Article Lastnames', 'Cited Article Firstnames', 'Cited Article Initials', 'Cited Dictionary Contained Firstname Key?']) + '\n')
+
+            selfref_output = open(files['selfrefs'], 'w')
+            selfref_output.write('\t'.join(selfref_columns) + '\n')
+
+            checkpoint = open(files['checkpoint'], 'w')
+            checkpoint.write('\t'.join([file + ' Bytes' for file in output_files] + ['Completed Main Article PubmedIDs']) + '\n')
+        else:
+            main_badrequests_output = open(files['main_badrequests'], 'a')
+            refs_badrequests_output = open(files['refs_badrequests'], 'a')
+            output = open(files['output'], 'a') if files['output'] else None
+            selfref_output = open(files['selfrefs'], 'a')
+            checkpoint = open(files['checkpoint'], 'a')
+
+        outputs = [handle for handle in (output, main_badrequests_output, refs_badrequests_output, selfref_output) if handle]
+        if not completed_pmids:
+            record_checkpoint(checkpoint, [], outputs)
+
+        # MAIN ARTICLES ARE CRAWLED IN CHUNKS SO THAT ALL WORKERS STAY BUSY WHILE RESULTS ARE STILL WRITTEN IN SORTED PMID ORDER.
+        # EACH CHUNK IS RECORDED IN THE CHECKPOINT JOURNAL ONLY AFTER ITS RESULTS HAVE BEEN WRITTEN TO DISK.
+        remaining_pmids = [pmid for pmid in all_pmids if pmid not in completed_pmids]
+        progress = tqdm(total=len(all_pmids), initial=len(all_pmids)-len(remaining_pmids))
+        for chunk_start in range(0, len(remaining_pmids), main_articles_per_chunk):
+            chunk = remaining_pmids[chunk_start:chunk_start+main_articles_per_chunk]
+            main_authorlists, ref_lists, ref_authorlists = crawl_main_articles(pool, eutils, chunk, pmids_per_request, links_per_request, cache)
+            write_results(chunk, main_authorlists, ref_lists, ref_authorlists, output, main_badrequests_output, refs_badrequests_output)
+            write_selfreference_rows(journal_arg, chunk, main_authorlists, ref_lists, ref_authorlists, selfref_output)
+            record_checkpoint(checkpoint, chunk, outputs)
+
+            progress.update(len(chunk))
+        progress.close()
+
+        for handle in outputs + [checkpoint]:
+            handle.close()
+
+    combine_selfreference_tables([get_journal_files(journal_arg, write_author_search)['selfrefs'] for journal_arg in journal_args], selfref_table_file)
+
+    pool.shutdown()
+    cache['connection'].close()
+    print('Requests:', eutils['stats']['requests'], 'Retries:', eutils['stats']['retries'], 'Failed requests:', eutils['stats']['failures'])
+
+
+def get_journal_files(journal_arg, write_author_search=True):
+    """Name the output files written for a journal.
+    Returns:
+        files = dictionary of file names (the author search file is None when it is not written)
+    """
+
+    files = {'output':'Pubmed_AuthorSearch_' + journal_arg + '.tsv' if write_author_search else None,
+        'main_badrequests':'FailedQueries_for_MainArticle_PubmedIDs_' + journal_arg + '.txt',
+        'refs_badrequests':'FailedQueries_for_RefArticle_PubmedIDs_' + journal_arg + '.tsv',
+        'selfrefs':'SelfReferencingRate_Estimates_' + journal_arg + '.tsv',
+        'checkpoint':'Checkpoint_' + journal_arg + '.tsv'}
+
+    return files
+
+
+def crawl_main_articles(pool, eutils, main_pmids, pmids_per_request, links_per_request, cache=None):
+    """Retrieve the author lists and reference lists for a group of main articles, followed by the
+    author lists for the distinct articles that they cite. References already resolved earlier in
+    the run (or in an earlier run) are taken from the cache, so each distinct reference is fetched once.
+    Returns:
+        main_authorlists = dictionary with main article PMIDs as keys and parse_authorlist() tuples as values
+        ref_lists = dictionary with main article PMIDs as keys and lists of cited PMIDs as values
+        ref_authorlists = dictionary with cited PMIDs as keys and parse_authorlist() tuples as values
+    """
+
+    main_authorlists = fetch_authorlists(pool, eutils, main_pmids, pmids_per_request, cache)
+    ref_lists = fetch_reference_lists(pool, eutils, [main_pmid for main_pmid in main_pmids if main_pmid in main_authorlists], links_per_request, cache)
+
+    ref_pmids = sorted(set([ref_pmid for id_list in ref_lists.values() for ref_pmid in id_list]))
+    ref_authorlists = fetch_authorlists(pool, eutils, ref_pmids, pmids_per_request, cache)
+
+    return main_authorlists, ref_lists, ref_authorlists
+
+
+def write_results(main_pmids, main_authorlists, ref_lists, ref_authorlists, output, main_badrequests_output, refs_badrequests_output):
+    """Write one row per (main article, cited article) pair to the author search file (skipped when
+    output is None), and record main articles and references that could not be retrieved in the
+    FailedQueries files.
+    Returns:
+        None
+    """
+
+    for main_pmid in main_pmids:
+        if main_pmid not in main_authorlists or main_pmid not in ref_lists:
+            main_badrequests_output.write(main_pmid + '\n')
+            continue
+
+        main_art_combinednames, main_art_lastnames, main_art_firstnames, main_art_initials, main_art_containedfirstnames = main_authorlists[main_pmid]
+        for ref_pmid in ref_lists[main_pmid]:
+            ref_authors = ref_authorlists.get(ref_pmid)
+            if not ref_authors:
+                refs_badrequests_output.write('\t'.join([main_pmid, ref_pmid]) + '\n')
+                continue
+            if not output:
                 continue
 
-            for ref_pmid in id_list:
-                successful_ref = False
-                iternum = 0
-                while not successful_ref and iternum < max_tries:
-                    try:
-                        if iternum != 0:
-                            print(iternum, main_pmid, ref_pmid)
-                        iternum += 1
-                        ref_art_combinednames, ref_art_lastnames, ref_art_firstnames, ref_art_initials, ref_art_containedfirstnames = get_authorlist(ref_pmid)
-                        
-                        output.write('\t'.join([main_pmid, ';'.join(main_art_combinednames), ';'.join(main_art_lastnames), ';'.join(main_art_firstnames), ';'.join(main_art_initials), main_art_containedfirstnames, ref_pmid, ';'.join(ref_art_combinednames), ';'.join(ref_art_lastnames), ';'.join(ref_art_firstnames), ';'.join(ref_art_initials), ref_art_containedfirstnames]) + '\n')
-                        successful_ref = True
-
-                    except:
-                        continue
-                        
-                if iternum == max_tries:
-                    refs_badrequests_output.write('\t'.join([main_pmid, ref_pmid]) + '\n')
-                    continue
-
-        main_badrequests_output.close()
-        refs_badrequests_output.close()
+            ref_art_combinednames, ref_art_lastnames, ref_art_firstnames, ref_art_initials, ref_art_containedfirstnames = ref_authors
+            output.write('\t'.join([main_pmid, ';'.join(main_art_combinednames), ';'.join(main_art_lastnames), ';'.join(main_art_firstnames), ';'.join(main_art_initials), main_art_containedfirstnames, ref_pmid, ';'.join(ref_art_combinednames), ';'.join(ref_art_lastnames), ';'.join(ref_art_firstnames), ';'.join(ref_art_initials), ref_art_containedfirstnames]) + '\n')
+
+
+def write_selfreference_rows(journal_arg, main_pmids, main_authorlists, ref_lists, ref_authorlists, selfref_output):
+    """Calculate exact-name and initial-level self-reference counts for each main article whose author
+    list and references were resolved, and write one TableS1 row per article. The author keys of every
+    cited article are built once per chunk (see get_author_key_index()), so a reference cited by many
+    main articles is only normalized once. Main articles without any resolved references are left out.
+    Returns:
+        None
+    """
+
+    ref_key_index = get_author_key_index(ref_authorlists)
+
+    for main_pmid in main_pmids:
+        if main_pmid not in main_authorlists or main_pmid not in ref_lists:
+            continue
+        resolved_refs = [ref_key_index[ref_pmid] for ref_pmid in ref_lists[main_pmid] if ref_pmid in ref_key_index]
+        if len(resolved_refs) == 0:
+            continue
+
+        combinednames = main_authorlists[main_pmid][0]
+        name_keys, initials_keys = get_author_keys(main_authorlists[main_pmid])
+        total_refs = len(resolved_refs)
+
+        row = [journal_arg, main_pmid, ';'.join(combinednames)]
+        for level, main_keys in enumerate((name_keys, initials_keys)):
+            all_author_num_selfrefs, max_author, num_selfrefs = calc_selfreferences(combinednames, main_keys, [ref_keys[level] for ref_keys in resolved_refs])
+            row += [str(all_author_num_selfrefs), str(all_author_num_selfrefs / total_refs * 100), max_author, str(num_selfrefs)]
+            if level == 0:
+                row += [str(total_refs)]
+            row += [str(num_selfrefs / total_refs * 100)]
+        selfref_output.write('\t'.join(row) + '\n')
+
+
+def calc_selfreferences(main_names, main_keys, ref_keysets):
+    """Count self-references for a main article by intersecting the set of its author keys with the
+    precomputed key set of each cited article. Each intersection only looks up the keys of the
+    smaller set, so the cost grows linearly with the number of authors instead of with the product
+    of the two author list lengths.
+    Returns:
+        all_author_num_selfrefs = number of cited articles that share at least one author with the main article
+        max_author = main article author with the most self-references (first in author order on ties)
+        num_selfrefs = number of self-references for max_author
+    """
+
+    main_key_set = frozenset(main_keys)
+
+    all_author_num_selfrefs = 0
+    author_counts = dict.fromkeys(main_key_set, 0)
+    for ref_keys in ref_keysets:
+        shared_keys = main_key_set & ref_keys
+        if shared_keys:
+            all_author_num_selfrefs += 1
+            for key in shared_keys:
+                author_counts[key] += 1
+
+    max_author = ''
+    num_selfrefs = 0
+    for i, key in enumerate(main_keys):
+        if author_counts[key] > num_selfrefs:
+            max_author = main_names[i]
+            num_selfrefs = author_counts[key]
+
+    return all_author_num_selfrefs, max_author, num_selfrefs
+
+
+def get_author_key_index(authorlists):
+    """Build the exact-name and initial-level key sets of every article in a set of author lists.
+    Returns:
+        key_index = dictionary with PMIDs as keys and (frozenset of normalized names, frozenset of
+                last name + initials keys) tuples as values
+    """
+
+    key_index = {}
+    for pmid in authorlists:
+        name_keys, initials_keys = get_author_keys(authorlists[pmid])
+        key_index[pmid] = (frozenset(name_keys), frozenset(initials_keys))
+
+    return key_index
+
+
+def get_author_keys(authorlist):
+    """Get the matching keys of every author in a parse_authorlist() tuple, in author order. Exact-name keys
+    are the normalized combined names. Initial-level keys are the normalized last name followed by the
+    author's initials (taken from the first names when PubMed gives no Initials), so that e.g.
+    "Jean-Pierre Müller" and "J P Muller" match.
+    Returns:
+        name_keys = list of normalized combined names
+        initials_keys = list of last name + initials keys
+    """
+
+    combinednames, lastnames, firstnames, initials, containedfirstnames = authorlist
+
+    name_keys = [normalize_name(name) for name in combinednames]
+    initials_keys = []
+    for lastname, firstname, initial in zip(lastnames, firstnames, initials):
+        if not initial:
+            initial = ' '.join([part[0] for part in fold_name(firstname).replace('-', ' ').replace('.', ' ').split()])
+        initials_keys.append(normalize_name(lastname) + ' ' + ''.join([char for char in fold_name(initial) if char.isalnum()]))
+
+    return name_keys, initials_keys
+
+
+def normalize_name(name):
+    """Normalize an author name for matching (accents removed, case-folded, periods removed, whitespace collapsed).
+    Returns:
+        name = normalized name
+    """
+
+    return ' '.join(fold_name(name).replace('.', ' ').split())
+
+
+def fold_name(name):
+    """Case-fold a name and strip accents and other diacritics (e.g. "Müller" -> "muller", "Łukasz" -> "lukasz").
+    Returns:
+        name = folded name
+    """
+
+    name = name.casefold()
+    if name.isascii():
+        return name
+
+    name = ''.join([char for char in unicodedata.normalize('NFKD', name) if not unicodedata.combining(char)])
+
+    return name.translate(folded_letters)
+
+
+def combine_selfreference_tables(selfref_files, selfref_table_file):
+    """Concatenate the per-journal self-reference files into a single TableS1 file.
+    Returns:
+        None
+    """
+
+    output = open(selfref_table_file + '.tmp', 'w')
+    output.write('\t'.join(selfref_columns) + '\n')
+    for file in selfref_files:
+        if not os.path.exists(file):
+            continue
+        h = open(file)
+        header = h.readline()
+        for line in h:
+            output.write(line)
+        h.close()
+    output.close()
+    os.replace(selfref_table_file + '.tmp', selfref_table_file)
+
+
+def record_checkpoint(checkpoint, completed_pmids, outputs):
+    """Flush the output files to disk, then append their sizes and the newly completed main article
+    PMIDs to the checkpoint journal.
+    Returns:
+        None
+    """
+
+    sizes = []
+    for output in outputs:
+        output.flush()
+        os.fsync(output.fileno())
+        sizes.append(os.fstat(output.fileno()).st_size)
+
+    checkpoint.write('\t'.join([str(size) for size in sizes] + [','.join(completed_pmids)]) + '\n')
+    checkpoint.flush()
+    os.fsync(checkpoint.fileno())
+
+
+def get_header(file):
+    """Read the column names of a tab-separated file.
+    Returns:
+        header = list of column names (None if the file does not exist)
+    """
+
+    if not os.path.exists(file):
+        return None
+
+    h = open(file)
+    header = h.readline().rstrip('\n').split('\t')
+    h.close()
+
+    return header
+
+
+def load_checkpoint(checkpoint_file, output_files):
+    """Read the checkpoint journal of an interrupted crawl. The output files are truncated back to
+    the sizes recorded by the last complete journal entry, which removes any rows written after
+    that entry, and a partially written final entry is dropped from the journal.
+    Returns:
+        completed_pmids = set of main article PMIDs that were fully processed (None if there is
+                nothing to resume from, or if the journal tracks a different set of output files)
+    """
+
+    if not os.path.exists(checkpoint_file) or not all([os.path.exists(file) for file in output_files]):
+        return None
+
+    h = open(checkpoint_file, 'rb')
+    header = h.readline()
+    valid_size = len(header)
+    if header.decode().rstrip('\n').split('\t')[:-1] != [file + ' Bytes' for file in output_files]:
+        h.close()
+        return None
+
+    completed_pmids = set()
+    sizes = None
+    for line in h:
+        items = line.decode().split('\t')
+        if not line.endswith(b'\n') or len(items) != len(output_files) + 1:
+            break
+        sizes = [int(size) for size in items[:-1]]
+        completed_pmids.update([pmid for pmid in items[-1].rstrip('\n').split(',') if pmid])
+        valid_size += len(line)
+    h.close()
+
+    if sizes is None:
+        return None
+
+    os.truncate(checkpoint_file, valid_size)
+    for file, size in zip(output_files, sizes):
+        os.truncate(file, size)
+
+    return completed_pmids
+
+
+def replay_failed_queries(pool, eutils, cache, journal_arg, files, main_articles_per_chunk, pmids_per_request, links_per_request):
+    """Re-query only the main articles and (main article, reference) pairs listed in the FailedQueries
+    files from an earlier run. Recovered rows are appended to the author search file, the
+    self-reference rows of every affected main article are recalculated, and the FailedQueries
+    files are replaced by the entries that failed again. A missing FailedQueries file (e.g. the journal was
+    never crawled, or the file was cleaned up) is treated as having nothing to replay.
+    Returns:
+        None
+    """
+
+    failed_main_pmids = []
+    if os.path.exists(files['main_badrequests']):
+        h = open(files['main_badrequests'])
+        failed_main_pmids = [line.rstrip() for line in h if line.strip()]
+        h.close()
+
+    header = '\t'.join(refs_badrequests_columns) + '\n'
+    failed_citations = []
+    if os.path.exists(files['refs_badrequests']):
+        h = open(files['refs_badrequests'])
+        header = h.readline()
+        failed_citations = [line.rstrip('\n').split('\t') for line in h if line.strip()]
+        h.close()
+
+    if not failed_main_pmids and not failed_citations:
+        return
+
+    output = open(files['output'], 'a') if files['output'] else None
+    main_badrequests_output = open(files['main_badrequests'] + '.tmp', 'w')
+    refs_badrequests_output = open(files['refs_badrequests'] + '.tmp', 'w')
+    refs_badrequests_output.write(header)
+    selfref_output = open(files['selfrefs'] + '.new', 'w')
+
+    # FAILED MAIN ARTICLES ARE CRAWLED AGAIN IN FULL
+    for chunk_start in tqdm(range(0, len(failed_main_pmids), main_articles_per_chunk)):
+        chunk = failed_main_pmids[chunk_start:chunk_start+main_articles_per_chunk]
+        main_authorlists, ref_lists, ref_authorlists = crawl_main_articles(pool, eutils, chunk, pmids_per_request, links_per_request, cache)
+        write_results(chunk, main_authorlists, ref_lists, ref_authorlists, output, main_badrequests_output, refs_badrequests_output)
+        write_selfreference_rows(journal_arg, chunk, main_authorlists, ref_lists, ref_authorlists, selfref_output)
+
+    # FAILED REFERENCES ONLY NEED THE AUTHOR LISTS OF THE MAIN AND CITED ARTICLES. THE FULL REFERENCE LISTS (MOSTLY CACHED) ARE
+    # RESOLVED AS WELL SO THAT THE SELF-REFERENCE ROWS OF THESE MAIN ARTICLES CAN BE RECALCULATED.
+    failed_ref_lists = {}
+    for main_pmid, ref_pmid in failed_citations:
+        failed_ref_lists[main_pmid] = failed_ref_lists.get(main_pmid, []) + [ref_pmid]
+    main_authorlists = fetch_authorlists(pool, eutils, list(failed_ref_lists), pmids_per_request, cache)
+    ref_lists = fetch_reference_lists(pool, eutils, [main_pmid for main_pmid in failed_ref_lists if main_pmid in main_authorlists], links_per_request, cache)
+    ref_pmids = sorted(set([ref_pmid for main_pmid, ref_pmid in failed_citations] + [ref_pmid for id_list in ref_lists.values() for ref_pmid in id_list]))
+    ref_authorlists = fetch_authorlists(pool, eutils, ref_pmids, pmids_per_request, cache)
+    for main_pmid in failed_ref_lists:
+        if main_pmid not in main_authorlists:
+            refs_badrequests_output.write(''.join([main_pmid + '\t' + ref_pmid + '\n' for ref_pmid in failed_ref_lists[main_pmid]]))
+    write_results([main_pmid for main_pmid in failed_ref_lists if main_pmid in main_authorlists], main_authorlists, failed_ref_lists, ref_authorlists, output, main_badrequests_output, refs_badrequests_output)
+    write_selfreference_rows(journal_arg, list(failed_ref_lists), main_authorlists, ref_lists, ref_authorlists, selfref_output)
+
+    main_badrequests_output.close()
+    refs_badrequests_output.close()
+    selfref_output.close()
+    os.replace(files['main_badrequests'] + '.tmp', files['main_badrequests'])
+    os.replace(files['refs_badrequests'] + '.tmp', files['refs_badrequests'])
+    replace_selfreference_rows(files['selfrefs'], files['selfrefs'] + '.new')
+
+    # RECORD THE NEW FILE SIZES SO THAT A LATER RESUME DOES NOT TRUNCATE THE RECOVERED ROWS
+    if os.path.exists(files['checkpoint']):
+        outputs = [output] if output else []
+        outputs += [open(files[key], 'a') for key in ('main_badrequests', 'refs_badrequests', 'selfrefs')]
+        checkpoint = open(files['checkpoint'], 'a')
+        record_checkpoint(checkpoint, [], outputs)
+        checkpoint.close()
+        for handle in outputs:
+            handle.close()
+    elif output:
         output.close()
-        
-        
-def get_authorlist(pmid):
 
-    handle = Entrez.efetch(db="pubmed", id=pmid, retmax='1', retmode="xml", api_key=my_key)
-    results = Entrez.read(handle)
-    authors = results['PubmedArticle'][0]['MedlineCitation']['Article']['AuthorList']
+
+def replace_selfreference_rows(selfref_file, new_rows_file):
+    """Replace the self-reference rows of recalculated main articles, keeping all other rows.
+    Returns:
+        None
+    """
+
+    h = open(new_rows_file)
+    new_rows = h.readlines()
+    h.close()
+    recalculated_pmids = set([row.split('\t')[1] for row in new_rows])
+
+    output = open(selfref_file + '.tmp', 'w')
+    if os.path.exists(selfref_file):
+        h = open(selfref_file)
+        for line in h:
+            if line.split('\t')[1] not in recalculated_pmids:
+                output.write(line)
+        h.close()
+    else:
+        output.write('\t'.join(selfref_columns) + '\n')
+    for row in new_rows:
+        output.write(row)
+    output.close()
+
+    os.replace(selfref_file + '.tmp', selfref_file)
+    os.remove(new_rows_file)
+
+
+def get_reference_lists(pmids, eutils):
+    """Retrieve the lists of PMIDs cited by many main articles with a single elink request. Each PMID
+    is sent as a separate id parameter so that PubMed returns one LinkSet per main article.
+    Returns:
+        ref_lists = dictionary with main article PMIDs as keys and lists of cited PMIDs as values
+                (articles without a reference list are left out)
+    """
+
+    return query_eutils(eutils, 'elink', {'db':'pubmed', 'dbfrom':'pubmed', 'LinkName':'pubmed_pubmed_refs', 'id':list(pmids)}, parse_reference_lists_xml)
+
+
+def parse_reference_lists_xml(payload):
+    """Extract the cited PMIDs of each main article from an elink XML response.
+    Returns:
+        ref_lists = dictionary with main article PMIDs as keys and lists of cited PMIDs as values
+                (articles without a reference list are left out)
+    """
+
+    ref_lists = {}
+    for event, element in ET.iterparse(io.BytesIO(payload)):
+        if element.tag != 'LinkSet':
+            continue
+        source_pmid = element.findtext('IdList/Id')
+        linksetdb = element.find('LinkSetDb')
+        if source_pmid and linksetdb is not None:
+            id_list = [link.findtext('Id') for link in linksetdb.findall('Link')]
+            if id_list:
+                ref_lists[source_pmid.strip()] = id_list
+        element.clear()
+
+    return ref_lists
+
+
+def query_reference_list_batch(eutils, pmids):
+    """Retrieve reference lists for one batch of main articles, treating a failed request as an empty result.
+    Returns:
+        ref_lists = dictionary with main article PMIDs as keys and lists of cited PMIDs as values
+    """
+
+    try:
+        return get_reference_lists(pmids, eutils)
+    except Exception:
+        return {}
+
+
+def fetch_reference_lists(pool, eutils, pmids, links_per_request, cache=None):
+    """Retrieve the reference lists for many main articles, taking them from the cache when
+    possible. The remaining articles are sent with up to links_per_request PMIDs in each elink
+    request and the requests spread across the worker pool.
+    Returns:
+        ref_lists = dictionary with PMIDs as keys and lists of cited PMIDs as values (PMIDs whose
+                query failed are left out)
+    """
+
+    ref_lists = cache_get_many(cache, 'reference_lists', pmids) if cache else {}
+    missing_pmids = [pmid for pmid in pmids if pmid not in ref_lists]
+    batches = [missing_pmids[i:i+links_per_request] for i in range(0, len(missing_pmids), links_per_request)]
+
+    fetched_ref_lists = {}
+    for batch_ref_lists in pool.map(partial(query_reference_list_batch, eutils), batches):
+        fetched_ref_lists.update(batch_ref_lists)
+    if cache:
+        cache_put_many(cache, 'reference_lists', fetched_ref_lists)
+    ref_lists.update(fetched_ref_lists)
+
+    return ref_lists
+
+
+def fetch_authorlists(pool, eutils, pmids, pmids_per_request, cache=None):
+    """Fetch author lists for many PMIDs, taking them from the cache when possible. The remaining
+    PMIDs are fetched with up to pmids_per_request PMIDs in each efetch request and the requests
+    spread across the worker pool.
+    Returns:
+        authorlists = dictionary with PMIDs as keys and parse_authorlist() tuples as values (PMIDs
+                that could not be retrieved or parsed are left out)
+    """
+
+    authorlists = cache_get_many(cache, 'authorlists', pmids) if cache else {}
+    missing_pmids = [pmid for pmid in pmids if pmid not in authorlists]
+    batches = [missing_pmids[i:i+pmids_per_request] for i in range(0, len(missing_pmids), pmids_per_request)]
+
+    fetched_authorlists = {}
+    for batch_authorlists in pool.map(partial(query_authorlist_batch, eutils), batches):
+        fetched_authorlists.update(batch_authorlists)
+    if cache:
+        cache_put_many(cache, 'authorlists', fetched_authorlists)
+    authorlists.update(fetched_authorlists)
+
+    return authorlists
+
+
+def query_authorlist_batch(eutils, pmids):
+    """Fetch author lists for one batch of PMIDs, treating a failed request as an empty result.
+    Returns:
+        authorlists = dictionary with PMIDs as keys and parse_authorlist() tuples as values
+    """
+
+    try:
+        return get_authorlists(pmids, eutils)
+    except Exception:
+        return {}
+
+
+def open_cache(file, ttl_days, max_entries):
+    """Open (or create) the SQLite cache of parsed author lists (PMID -> parse_authorlist() tuple) and
+    reference lists (PMID -> cited PMIDs), and remove entries older than the TTL. Failed queries are
+    never cached. The number of rows in each table is counted once here and then tracked in memory
+    by cache_put_many().
+    Returns:
+        cache = dictionary with the database connection, TTL (seconds), maximum entries per table and
+                current number of entries per table
+    """
+
+    connection = sqlite3.connect(file)
+    num_entries = {}
+    for table in ('authorlists', 'reference_lists'):
+        connection.execute('CREATE TABLE IF NOT EXISTS ' + table + ' (pmid TEXT PRIMARY KEY, value TEXT NOT NULL, fetched REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ' + table + '_fetched ON ' + table + ' (fetched)')
+        connection.execute('DELETE FROM ' + table + ' WHERE fetched < ?', (time.time() - ttl_days*86400,))
+        num_entries[table] = connection.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+    connection.commit()
+
+    cache = {'connection':connection, 'ttl':ttl_days*86400, 'max_entries':max_entries, 'num_entries':num_entries}
+
+    return cache
+
+
+def cache_get_many(cache, table, pmids, max_variables=500):
+    """Look up unexpired cache entries for a list of PMIDs.
+    Returns:
+        values = dictionary with the cached PMIDs as keys and decoded values as values (author
+                lists are returned as tuples, reference lists as lists)
+    """
+
+    oldest = time.time() - cache['ttl']
+    values = {}
+    for i in range(0, len(pmids), max_variables):
+        batch = pmids[i:i+max_variables]
+        rows = cache['connection'].execute('SELECT pmid, value FROM ' + table + ' WHERE fetched >= ? AND pmid IN (' + ','.join('?'*len(batch)) + ')', [oldest] + list(batch))
+        for pmid, value in rows:
+            value = json.loads(value)
+            values[pmid] = tuple(value) if table == 'authorlists' else value
+
+    return values
+
+
+def cache_put_many(cache, table, values, max_variables=500):
+    """Store newly fetched values in the cache, then evict the oldest entries if the table has grown
+    beyond the maximum number of entries. The table size is kept up to date in memory (PMIDs that are
+    already cached are looked up by primary key and not counted again), so no write scans the table.
+    Returns:
+        None
+    """
+
+    if not values:
+        return
+
+    now = time.time()
+    connection = cache['connection']
+    pmids = list(values)
+    num_existing = 0
+    for i in range(0, len(pmids), max_variables):
+        batch = pmids[i:i+max_variables]
+        num_existing += connection.execute('SELECT COUNT(*) FROM ' + table + ' WHERE pmid IN (' + ','.join('?'*len(batch)) + ')', batch).fetchone()[0]
+    connection.executemany('INSERT OR REPLACE INTO ' + table + ' (pmid, value, fetched) VALUES (?, ?, ?)', [(pmid, json.dumps(value), now) for pmid, value in values.items()])
+    cache['num_entries'][table] += len(pmids) - num_existing
+
+    excess = cache['num_entries'][table] - cache['max_entries']
+    if excess > 0:
+        cache['num_entries'][table] -= connection.execute('DELETE FROM ' + table + ' WHERE pmid IN (SELECT pmid FROM ' + table + ' ORDER BY fetched LIMIT ?)', (excess,)).rowcount
+    connection.commit()
+
+
+def make_eutils_session(base_url, requests_per_second, max_tries, backoff_base, backoff_max, burst=1, timeout=60):
+    """Gather the settings shared by all E-utilities requests, including a token-bucket rate
+    limiter that is shared by all worker threads. A burst size of 1 spaces requests evenly.
+    Returns:
+        eutils = dictionary of settings, rate limiter state and request counters (including the
+                latency of every attempt, in seconds)
+    """
+
+    eutils = {'base_url':base_url,
+        'max_tries':max_tries,
+        'backoff_base':backoff_base,
+        'backoff_max':backoff_max,
+        'timeout':timeout,
+        'limiter':{'rate':requests_per_second, 'capacity':burst, 'tokens':burst, 'timestamp':time.monotonic(), 'lock':threading.Lock()},
+        'stats':{'requests':0, 'retries':0, 'failures':0, 'latencies':[]},
+        'stats_lock':threading.Lock()}
+
+    return eutils
+
+
+def acquire_token(limiter):
+    """Block until the token bucket holds a token, then take it.
+    Returns:
+        None
+    """
+
+    while True:
+        with limiter['lock']:
+            now = time.monotonic()
+            limiter['tokens'] = min(limiter['capacity'], limiter['tokens'] + (now - limiter['timestamp']) * limiter['rate'])
+            limiter['timestamp'] = now
+            if limiter['tokens'] >= 1:
+                limiter['tokens'] -= 1
+                return
+            wait = (1 - limiter['tokens']) / limiter['rate']
+        time.sleep(wait)
+
+
+def query_eutils(eutils, utility, params, parse=None):
+    """Send one rate-limited request to an E-utility (e.g. 'efetch' or 'elink'). Connection errors,
+    HTTP 429 and HTTP 5xx responses are retried with exponential backoff and jitter (or after the
+    Retry-After delay sent by the server), up to max_tries attempts. If a parse function is given,
+    the response body is parsed before returning, and a truncated or malformed response (XML
+    ParseError) is retried in the same way.
+    Returns:
+        payload = raw response body (bytes), or the result of parse(payload) if parse is given
+    """
+
+    params = dict(params, tool='biopython', email=Entrez.email)
+    if my_key:
+        params['api_key'] = my_key
+    data = urllib.parse.urlencode(params, doseq=True).encode()
+    url = eutils['base_url'] + utility + '.fcgi'
+
+    for attempt in range(eutils['max_tries']):
+        acquire_token(eutils['limiter'])
+        with eutils['stats_lock']:
+            eutils['stats']['requests'] += 1
+            if attempt > 0:
+                eutils['stats']['retries'] += 1
+
+        retry_after = None
+        start = time.monotonic()
+        try:
+            response = urllib.request.urlopen(url, data=data, timeout=eutils['timeout'])
+            payload = response.read()
+            response.close()
+            with eutils['stats_lock']:
+                eutils['stats']['latencies'].append(time.monotonic() - start)
+            if parse is None:
+                return payload
+            start = None
+            return parse(payload)
+        except ET.ParseError:
+            pass
+        except urllib.error.HTTPError as error:
+            if error.code != 429 and error.code < 500:
+                break
+            if error.headers.get('Retry-After', '').isdigit():
+                retry_after = int(error.headers['Retry-After'])
+        except (urllib.error.URLError, http.client.HTTPException, OSError):
+            pass
+        if start is not None:    # THE LATENCY OF A RESPONSE THAT FAILED TO PARSE WAS ALREADY RECORDED
+            with eutils['stats_lock']:
+                eutils['stats']['latencies'].append(time.monotonic() - start)
+
+        if attempt < eutils['max_tries'] - 1:
+            delay = min(eutils['backoff_max'], eutils['backoff_base'] * 2**attempt) * random.uniform(0.5, 1.5)
+            time.sleep(retry_after if retry_after is not None else delay)
+
+    with eutils['stats_lock']:
+        eutils['stats']['failures'] += 1
+    raise IOError(utility + ' request failed after ' + str(attempt+1) + ' tries: ' + url)
+
+
+def get_authorlists(pmids, eutils):
+    """Fetch the records for a list of PMIDs with a single efetch request and parse the author list
+    of every article in the multi-article XML. Articles without a usable author list (e.g. no
+    AuthorList, or a collective author without a LastName) are left out, as are PMIDs that PubMed
+    did not return.
+    Returns:
+        authorlists = dictionary with PMIDs as keys and (combinednames, lastnames, firstnames,
+                initials, containedfirstnames) tuples as values
+    """
+
+    return query_eutils(eutils, 'efetch', {'db':'pubmed', 'id':','.join(pmids), 'retmode':'xml'}, parse_authorlists_xml)
+
+
+def parse_authorlists_xml(payload):
+    """Stream through an efetch XML response with iterparse and extract only the LastName, ForeName
+    and Initials of each author in MedlineCitation/Article/AuthorList. Each article is discarded
+    as soon as its authors have been read, so memory use does not grow with the number of
+    articles. Gives the same results as parsing the response with Entrez.read().
+    Returns:
+        authorlists = dictionary with PMIDs as keys and parse_authorlist() tuples as values
+    """
+
+    authorlists = {}
+    context = ET.iterparse(io.BytesIO(payload), events=('start', 'end'))
+    event, root = next(context)
+    for event, element in context:
+        if event != 'end' or element.tag not in ('PubmedArticle', 'PubmedBookArticle'):
+            continue
+
+        pmid = element.findtext('MedlineCitation/PMID')
+        authorlist = element.find('MedlineCitation/Article/AuthorList')
+        if element.tag == 'PubmedArticle' and pmid and authorlist is not None:
+            authors = [{child.tag:''.join(child.itertext()) for child in author if child.tag in ('LastName', 'ForeName', 'Initials')} for author in authorlist.findall('Author')]
+            try:
+                authorlists[pmid.strip()] = parse_authorlist(authors)
+            except KeyError:
+                pass
+
+        element.clear()
+        root.clear()
+
+    return authorlists
+
+
+def parse_authorlist(authors):
 
     lastnames = []
     firstnames = []
@@ -107,30 +871,14 @@ def get_authorlist(pmid):
     
     
 def get_pubmed_ids(journal):
+    """Get the PMIDs for a journal from the filtered PMID list. The zip archive is read once and indexed
+    by read_FilteredPMIDs.get_pmid_index(), so later journals are looked up without re-reading it.
+    Returns:
+        pmids = set of PMIDs for the journal
+    """
+
+    return get_journal_pmids(journal)
 
-    h = open('Filtered_PMIDs_AllJournals.csv')
-    df = {}
-    
-    total = 0
-    total_to_analyze = 0
-    header = h.readline()
-    for line in h:
-        items = line.rstrip().split(',')
-        if items[0] != journal:
-            continue
-        pmid = items[9]
-        if pmid == '':
-            total += 1
-            continue
-        df[pmid] = items
-        
-        total += 1
-        total_to_analyze += 1
-        
-    h.close()
 
-    return df
-    
-        
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
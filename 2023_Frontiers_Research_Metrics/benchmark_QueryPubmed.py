@@ -0,0 +1,274 @@
+
+from Bio import Entrez
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import random
+import tracemalloc
+import time
+import io
+import os
+import QueryPubmed
+from serve_MockEutilities import get_default_settings, start_server, get_article_xml, efetch_header, efetch_footer
+
+def main():
+
+    # THE CRAWLER IS RUN AGAINST A LOCAL MOCK E-UTILITIES SERVER, SO NO REQUESTS ARE SENT TO NCBI
+    port = 0    # 0 PICKS ANY FREE PORT
+    num_main_articles = 400
+    first_main_pmid = 30000000
+
+    # MOCK SERVER BEHAVIOR (SEE get_default_settings() IN serve_MockEutilities.py)
+    server_settings = get_default_settings()
+    server_settings.update({'latency':0.05, 'latency_jitter':0.05, 'error_rate':0.02, 'rate_limit':10, 'mean_references':40})
+
+    # CRAWLER CONFIGURATIONS TO COMPARE: (num_workers, requests_per_second, pmids_per_request, links_per_request, main_articles_per_chunk)
+    configurations = [(1, 10, 200, 200, 200),
+        (10, 10, 200, 200, 200),
+        (10, 10, 50, 50, 200),
+        (10, 10, 200, 200, 50)]
+    max_tries = 10
+    backoff_base = 0.5
+    backoff_max = 60
+
+    # XML PARSER COMPARISON: NUMBER OF ARTICLES IN EACH SYNTHETIC efetch PAYLOAD
+    parser_payload_sizes = [200, 1000, 5000]
+    parser_repeats = 3
+
+    # SELF-REFERENCE MATCHING COMPARISON: AUTHORS PER ARTICLE (LARGE CONSORTIUM PAPERS CITING EACH OTHER) AND CITED ARTICLES PER MAIN ARTICLE.
+    # THE PAIRWISE BASELINE IS SKIPPED WHEN IT WOULD NEED MORE THAN max_pairwise_comparisons NAME COMPARISONS.
+    matching_author_counts = [10, 100, 1000, 3000]
+    matching_num_refs = 50
+    matching_repeats = 3
+    max_pairwise_comparisons = 10**8
+
+    benchmark_parsers(parser_payload_sizes, parser_repeats, server_settings)
+    benchmark_selfreferences(matching_author_counts, matching_num_refs, matching_repeats, max_pairwise_comparisons)
+
+    server = start_server(port, server_settings)
+    base_url = 'http://127.0.0.1:' + str(server.server_address[1]) + '/'
+    main_pmids = [str(first_main_pmid + i) for i in range(num_main_articles)]
+
+    output = open('Benchmark_QueryPubmed_Results.tsv', 'w')
+    output.write('\t'.join(['# of Workers', 'Requests per Second Limit', 'PMIDs per efetch', 'PMIDs per elink', 'Main Articles per Chunk', 'Main Articles', 'Citations', 'Elapsed Time (s)', 'Requests', 'Requests/s', 'Retries', 'Failed Requests', 'Throttled (429)', 'Server Errors (5xx)', 'Median Latency (s)', '95th Percentile Latency (s)', '99th Percentile Latency (s)', 'Max Latency (s)', 'Main Articles/hour']) + '\n')
+    for num_workers, requests_per_second, pmids_per_request, links_per_request, main_articles_per_chunk in configurations:
+        server.stats = {key:0 for key in server.stats}
+        server.request_times = []
+        time.sleep(1)    # LET THE SERVER'S RATE-LIMIT WINDOW EMPTY BETWEEN RUNS
+
+        eutils = QueryPubmed.make_eutils_session(base_url, requests_per_second, max_tries, backoff_base, backoff_max)
+        elapsed, num_citations = run_crawl(eutils, main_pmids, num_workers, pmids_per_request, links_per_request, main_articles_per_chunk)
+
+        stats = eutils['stats']
+        latency_percentiles = np.percentile(stats['latencies'], [50, 95, 99, 100]) if stats['latencies'] else [float('nan')]*4
+        row = [num_workers, requests_per_second, pmids_per_request, links_per_request, main_articles_per_chunk, num_main_articles, num_citations, round(elapsed, 2), stats['requests'], round(stats['requests'] / elapsed, 2), stats['retries'], stats['failures'], server.stats['throttled'], server.stats['errors']] + [round(x, 4) for x in latency_percentiles] + [round(num_main_articles / elapsed * 3600)]
+        output.write('\t'.join([str(x) for x in row]) + '\n')
+        print('\t'.join([str(x) for x in row]))
+
+    output.close()
+    server.shutdown()
+
+
+def benchmark_parsers(payload_sizes, repeats, server_settings):
+    """Compare Entrez.read() with the streaming iterparse extractor used by QueryPubmed.get_authorlists()
+    on multi-article efetch payloads, checking that both give identical author lists.
+    Returns:
+        None
+    """
+
+    output = open('Benchmark_PubmedXML_Parsers.tsv', 'w')
+    output.write('\t'.join(['# of Articles', 'Payload Size (MB)', 'Parser', 'Best Time (s)', 'Articles/s', 'Peak Memory (MB)']) + '\n')
+    for num_articles in payload_sizes:
+        payload = (efetch_header + ''.join([get_article_xml(str(10000000 + i), server_settings) for i in range(num_articles)]) + efetch_footer).encode()
+
+        results = {}
+        for parser_name, parser in (('Entrez.read', parse_with_entrez), ('iterparse', QueryPubmed.parse_authorlists_xml)):
+            times = []
+            for i in range(repeats):
+                start = time.perf_counter()
+                results[parser_name] = parser(payload)
+                times.append(time.perf_counter() - start)
+
+            tracemalloc.start()
+            parser(payload)
+            peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            row = [num_articles, round(len(payload) / 1024**2, 2), parser_name, round(min(times), 4), round(num_articles / min(times)), round(peak_memory / 1024**2, 2)]
+            output.write('\t'.join([str(x) for x in row]) + '\n')
+            print('\t'.join([str(x) for x in row]))
+
+        if results['Entrez.read'] != results['iterparse']:
+            print('WARNING: parsers disagree for the ' + str(num_articles) + '-article payload')
+
+    output.close()
+
+
+def parse_with_entrez(payload):
+    """Parse an efetch payload the way QueryPubmed.get_authorlists() did before the streaming extractor.
+    Returns:
+        authorlists = dictionary with PMIDs as keys and parse_authorlist() tuples as values
+    """
+
+    results = Entrez.read(io.BytesIO(payload))
+
+    authorlists = {}
+    for article in results['PubmedArticle']:
+        try:
+            authorlists[str(article['MedlineCitation']['PMID'])] = QueryPubmed.parse_authorlist(article['MedlineCitation']['Article']['AuthorList'])
+        except KeyError:
+            continue
+
+    return authorlists
+
+
+def benchmark_selfreferences(author_counts, num_refs, repeats, max_pairwise_comparisons, seed=0):
+    """Compare the key index used by QueryPubmed.write_selfreference_rows() with a pairwise comparison of
+    every main article author against every cited article author, on synthetic articles where each cited
+    article shares about a third of its authors with the main article (half of them spelled without
+    accents or with initials only). Both methods must give identical exact-name and initial-level counts.
+    Returns:
+        None
+    """
+
+    output = open('Benchmark_SelfReference_Matching.tsv', 'w')
+    output.write('\t'.join(['# of Authors', 'Cited Articles', 'Method', 'Best Time (s)', 'Exact-Name Self-References', 'Initial-Level Self-References']) + '\n')
+    for num_authors in author_counts:
+        main_authorlist, ref_authorlists = get_consortium_authorlists(num_authors, num_refs, random.Random(seed))
+
+        results = {}
+        for method_name, method in (('key index', match_with_key_index), ('pairwise', match_pairwise)):
+            if method_name == 'pairwise' and 2 * num_authors * num_authors * num_refs > max_pairwise_comparisons:
+                continue
+            times = []
+            for i in range(repeats):
+                start = time.perf_counter()
+                results[method_name] = method(main_authorlist, ref_authorlists)
+                times.append(time.perf_counter() - start)
+
+            row = [num_authors, num_refs, method_name, round(min(times), 4), results[method_name][0][0], results[method_name][1][0]]
+            output.write('\t'.join([str(x) for x in row]) + '\n')
+            print('\t'.join([str(x) for x in row]))
+
+        if 'pairwise' in results and results['pairwise'] != results['key index']:
+            print('WARNING: self-reference matching methods disagree for ' + str(num_authors) + ' authors')
+
+    output.close()
+
+
+def get_consortium_authorlists(num_authors, num_refs, rng):
+    """Make a synthetic main article and cited articles with num_authors authors each. Names include accented
+    letters, and about a third of each cited article's authors are main article authors, half of whom are
+    spelled without accents or with initials only.
+    Returns:
+        main_authorlist = parse_authorlist() tuple for the main article
+        ref_authorlists = dictionary with PMIDs as keys and parse_authorlist() tuples as values
+    """
+
+    syllables = ['an', 'be', 'ço', 'dí', 'el', 'fa', 'gö', 'ha', 'ki', 'lu', 'mé', 'no', 'ør', 'pa', 'ri', 'sa', 'tü', 'vo', 'ña', 'zé']
+
+    def get_author():
+        lastname = ''.join([rng.choice(syllables) for i in range(3)]).capitalize()
+        firstnames = [''.join([rng.choice(syllables) for i in range(2)]).capitalize() for i in range(rng.choice([1, 1, 2]))]
+        return {'LastName':lastname, 'ForeName':' '.join(firstnames), 'Initials':''.join([name[0] for name in firstnames])}
+
+    main_authors = [get_author() for i in range(num_authors)]
+    main_authorlist = QueryPubmed.parse_authorlist(main_authors)
+
+    ref_authorlists = {}
+    for ref_num in range(num_refs):
+        ref_authors = []
+        for i in range(num_authors):
+            if rng.random() >= 1/3:
+                ref_authors.append(get_author())
+                continue
+            author = dict(rng.choice(main_authors))
+            variant = rng.random()
+            if variant < 0.25:
+                author = {key:QueryPubmed.fold_name(author[key]).title() for key in author}
+            elif variant < 0.5:
+                author['ForeName'] = author['Initials']
+            ref_authors.append(author)
+        ref_authorlists[str(ref_num)] = QueryPubmed.parse_authorlist(ref_authors)
+
+    return main_authorlist, ref_authorlists
+
+
+def match_with_key_index(main_authorlist, ref_authorlists):
+    """Count exact-name and initial-level self-references the way QueryPubmed.write_selfreference_rows() does.
+    Returns:
+        results = (exact-name, initial-level) tuples of QueryPubmed.calc_selfreferences() results
+    """
+
+    ref_key_index = QueryPubmed.get_author_key_index(ref_authorlists)
+    main_keys = QueryPubmed.get_author_keys(main_authorlist)
+
+    return tuple([QueryPubmed.calc_selfreferences(main_authorlist[0], main_keys[level], [ref_keys[level] for ref_keys in ref_key_index.values()]) for level in (0, 1)])
+
+
+def match_pairwise(main_authorlist, ref_authorlists):
+    """Count exact-name and initial-level self-references by comparing every main article author with every
+    author of each cited article.
+    Returns:
+        results = (exact-name, initial-level) tuples of QueryPubmed.calc_selfreferences() results
+    """
+
+    main_keys = QueryPubmed.get_author_keys(main_authorlist)
+    ref_keys = [QueryPubmed.get_author_keys(ref_authorlists[pmid]) for pmid in ref_authorlists]
+
+    results = []
+    for level in (0, 1):
+        all_author_num_selfrefs = 0
+        author_counts = [0] * len(main_keys[level])
+        for ref_keylist in [keys[level] for keys in ref_keys]:
+            shared = False
+            for i, main_key in enumerate(main_keys[level]):
+                for ref_key in ref_keylist:
+                    if main_key == ref_key:
+                        author_counts[i] += 1
+                        shared = True
+                        break
+            if shared:
+                all_author_num_selfrefs += 1
+
+        max_author = ''
+        num_selfrefs = 0
+        for i, count in enumerate(author_counts):
+            if count > num_selfrefs:
+                max_author = main_authorlist[0][i]
+                num_selfrefs = count
+        results.append((all_author_num_selfrefs, max_author, num_selfrefs))
+
+    return tuple(results)
+
+
+def run_crawl(eutils, main_pmids, num_workers, pmids_per_request, links_per_request, main_articles_per_chunk):
+    """Crawl a list of main articles exactly as QueryPubmed.main() does (with an empty in-memory
+    cache), discarding the written rows.
+    Returns:
+        elapsed = wall-clock time for the crawl (seconds)
+        num_citations = number of (main article, cited article) rows that would have been written
+    """
+
+    cache = QueryPubmed.open_cache(':memory:', 1, 10**9)
+    pool = ThreadPoolExecutor(max_workers=num_workers)
+    output = open(os.devnull, 'w')
+
+    num_citations = 0
+    start = time.monotonic()
+    for chunk_start in range(0, len(main_pmids), main_articles_per_chunk):
+        chunk = main_pmids[chunk_start:chunk_start+main_articles_per_chunk]
+        main_authorlists, ref_lists, ref_authorlists = QueryPubmed.crawl_main_articles(pool, eutils, chunk, pmids_per_request, links_per_request, cache)
+        QueryPubmed.write_results(chunk, main_authorlists, ref_lists, ref_authorlists, output, output, output)
+        QueryPubmed.write_selfreference_rows('Benchmark', chunk, main_authorlists, ref_lists, ref_authorlists, output)
+        num_citations += sum([len([ref_pmid for ref_pmid in ref_lists[main_pmid] if ref_pmid in ref_authorlists]) for main_pmid in chunk if main_pmid in main_authorlists and main_pmid in ref_lists])
+    elapsed = time.monotonic() - start
+
+    output.close()
+    pool.shutdown()
+    cache['connection'].close()
+
+    return elapsed, num_citations
+
+
+if __name__ == '__main__':
+    main()
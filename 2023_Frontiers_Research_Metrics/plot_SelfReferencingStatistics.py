@@ -1,113 +1,395 @@
 
 import matplotlib.pyplot as plt
 import seaborn as sns
-import statistics
+from fractions import Fraction
+import math
+import colorsys
 from scipy import stats
 import pandas as pd
+import numpy as np
 from matplotlib.lines import Line2D
-import random
+import multiprocessing
+import hashlib
+import os
+from read_FilteredPMIDs import get_pmid_years
+from read_JournalRegistry import get_journal_registry, get_figure_sets
 
-journal_sets = [['PlosBiol', 'PlosGenet', 'PlosPath', 'PlosMed', 'PlosCompBiol'], ['CurrBiol', 'Genetics', 'mBio', 'BMCmed', 'Bioinformatics', 'Cell', 'Nature', 'Science', 'MCB', 'JCellBiol']]
-journal_label_sets = [['PLOS Biology', 'PLOS Genetics', 'PLOS Pathogens', 'PLOS Medicine', 'PLOS Computational\nBiology'], ['Current Biology', 'Genetics', 'mBio', 'BMC Medicine','Bioinformatics', 'Cell', 'Nature', 'Science', 'Molecular and\nCellular Biology', 'J Cell Biology']]
-figure_panels = [('Fig1A', 'Fig1B'), ('Fig1C', 'Fig1D')]
-fig_heights = [5, 6]
+combined_key = 'AllJournalsCombined'
   
 
 def main():
 
-    output = open('TableS3_Summarized_SelfReferencingRate_DistributionStatistics_by_Journal.tsv', 'w')
-    output.write('\t'.join(['Journal', 'Median Self-Reference Percentage', 'Average Self-Reference Percentage'] + ['Score at ' + str(x) + 'th Percentile' for x in (10, 20, 25, 30, 40, 50, 60, 70, 75, 80, 90, 100)] + ['Median in '+str(pub_year) for pub_year in range(2003, 2023)]) + '\n')
-        
+    # JOURNALS, THEIR LABELS AND THE FIGURE PANELS THEY ARE PLOTTED IN COME FROM THE JOURNAL REGISTRY (SEE read_JournalRegistry.py).
+    # WITH include_all_journals SET TO True, EVERY OTHER JOURNAL IN THE FILTERED PMID LIST IS ALSO SUMMARIZED (IN THE TABLES ONLY).
+    registry_file = 'Journal_Registry.tsv'
+    include_all_journals = False
+    registry = get_journal_registry(registry_file, include_all_journals)
+
     minimum_references = 20
+    table_years = range(2003, 2023)
+    percentiles = [10, 20, 25, 30, 40, 50, 60, 70, 75, 80, 90, 100]
+    violin_gridsize = 100
+
+    # BOOTSTRAP CONFIDENCE INTERVALS FOR EACH (JOURNAL, YEAR) MEDIAN, DRAWN AS SHADED BANDS IN THE LINE PLOTS. EACH GROUP HAS ITS OWN
+    # RANDOM STREAM DERIVED FROM bootstrap_seed, THE JOURNAL AND THE YEAR, SO RESULTS DO NOT DEPEND ON num_workers OR ON WHICH OTHER
+    # JOURNALS ARE ANALYZED. bootstrap_memory_budget LIMITS THE SIZE (IN BYTES) OF THE RESAMPLED ARRAYS HELD AT ONCE BY EACH WORKER.
+    # SET bootstrap_resamples TO 0 TO SKIP THE BOOTSTRAP.
+    bootstrap_resamples = 10000
+    bootstrap_seed = 0
+    ci_level = 95
+    bootstrap_memory_budget = 128 * 1024**2
+    bootstrap_file = 'Bootstrap_YearlyMedian_SelfReferencePercentage_ConfidenceIntervals.tsv'
+
+    # EACH JOURNAL, AND ALL JOURNALS COMBINED, IS SUMMARIZED INTO ITS OWN SHARD (A PARQUET PARTITION IN shard_dir) BY ONE OF num_workers
+    # PROCESSES. ONLY SHARDS WHOSE INPUT ROWS OR SETTINGS CHANGED SINCE THE LAST RUN ARE RECOMPUTED (SEE <shard_dir>/manifest.tsv).
+    shard_dir = 'SelfReferencing_Shards'
+    num_workers = 4
+
+    # MAP: SPLIT THE SELF-REFERENCE RATES BY JOURNAL AND SUMMARIZE EACH NEW OR CHANGED SHARD
     pmid_to_year = get_pub_year_df()
-    
-    for i, journals in enumerate(journal_sets):
-    
-        journal_labels = journal_label_sets[i]
-        j_to_jlabel = {journal:journal_labels[i] for i, journal in enumerate(journals)}
-        fig_height = fig_heights[i]
-        fig_panel_tup = figure_panels[i]
-        
-        df = {'Publication Year':[],
-            'Journal':[],
-            'Self-Reference Percentage':[]}
-                    
-        df = get_selfref_rates(minimum_references, pmid_to_year, df, journals, j_to_jlabel)
-
-        percentile_scores = []
-        means = []
-        boxplot_locs = []
-
-        for xval, journal in enumerate(journal_labels):
-            vals = [df['Self-Reference Percentage'][i] for i in range(len(df['Self-Reference Percentage'])) if df['Journal'][i] == journal]
-            scores_at_percentiles = stats.scoreatpercentile(vals, [x for x in range(10, 110, 10)])
-            boxplot_percentiles = stats.scoreatpercentile(vals, [25, 75])
-            boxplot_locs.append(boxplot_percentiles)
-            
-            ave = statistics.mean(vals)
-            means.append(ave)
-            max_val = max(vals)
-            
-            pub_year_medians = []
-            for pub_year in range(2003, 2023):
-                temp_df = pd.DataFrame.from_dict(df)
-                temp_df = temp_df[temp_df['Publication Year'] == pub_year]
-                temp_df = temp_df[temp_df['Journal'] == journal]
-                year_vals = temp_df['Self-Reference Percentage']
-                if len(year_vals) > 0:
-                    med = stats.scoreatpercentile(temp_df['Self-Reference Percentage'], 50)
-                else:
-                    med = 'N/A'
-                pub_year_medians.append(med)
-            
-            output.write('\t'.join([journal.replace('\n', ' '), str(scores_at_percentiles[4]), str(ave)] + [str(x) for x in sorted(list(scores_at_percentiles) + list(boxplot_percentiles))] + [str(x) for x in pub_year_medians]) + '\n')
+    journal_rates = get_selfref_rates(minimum_references, pmid_to_year, [entry['Journal'] for entry in registry])
+    journal_rates[combined_key] = (np.concatenate([journal_rates[key][0] for key in journal_rates]), np.concatenate([journal_rates[key][1] for key in journal_rates]))
+    settings = {'percentiles':percentiles, 'violin_gridsize':violin_gridsize, 'bootstrap_resamples':bootstrap_resamples, 'bootstrap_seed':bootstrap_seed, 'ci_level':ci_level, 'bootstrap_memory_budget':bootstrap_memory_budget}
+    update_shards(journal_rates, settings, shard_dir, num_workers)
 
-            percentile_scores.append(scores_at_percentiles[:-1])    # LEAVE OUT 100 PERCENTILE MARK FROM PLOTS, SINCE VIOLIN EXTENDS TO MAX VALUE.
+    # REDUCE: GATHER ALL SHARD SUMMARIES, IN REGISTRY ORDER
+    labels = {entry['Journal']:entry['Label'] for entry in registry}
+    labels[combined_key] = 'All Journals Combined'
+    journal_summary, year_summary, violins = load_shards(shard_dir, list(journal_rates), labels)
 
-        plot_maindistributions(df, journal_labels, percentile_scores, means, boxplot_locs, fig_panel_tup[0], fig_height)
+    if bootstrap_resamples > 0:
+        write_bootstrap_table(bootstrap_file, year_summary, bootstrap_resamples, ci_level)
 
-        df = pd.DataFrame.from_dict(df)
-        years = sorted(list(set(df['Publication Year'])))
+    output = open('TableS3_Summarized_SelfReferencingRate_DistributionStatistics_by_Journal.tsv', 'w')
+    output.write('\t'.join(['Journal', 'Median Self-Reference Percentage', 'Average Self-Reference Percentage'] + ['Score at ' + str(x) + 'th Percentile' for x in percentiles] + ['Median in '+str(pub_year) for pub_year in table_years]) + '\n')
+    for key in journal_rates:
+        output.write(get_table_row(labels[key], journal_summary, year_summary, percentiles, table_years))
+    output.close()
 
-        median_df = make_median_df(df, years, journal_labels)
-        median_df = pd.DataFrame.from_dict(median_df)
-        
-        plot_year_lineplot(median_df, years, journals, journal_labels, fig_panel_tup[1], fig_height)
-        
-    # RUN CALCULATIONS FOR ALL PUBLICATIONS COMBINED
-    scores_at_percentiles = stats.scoreatpercentile(df['Self-Reference Percentage'], [x for x in range(10, 110, 10)])
-    boxplot_percentiles = stats.scoreatpercentile(df['Self-Reference Percentage'], [25, 75])
-    pub_year_medians = []
-    for pub_year in range(2003, 2023):
-        temp_df = df[df['Publication Year'] == pub_year]
-        year_vals = temp_df['Self-Reference Percentage']
-        if len(year_vals) > 0:
-            med = stats.scoreatpercentile(temp_df['Self-Reference Percentage'], 50)
-        else:
-            med = 'N/A'
-        pub_year_medians.append(med)
-    
-    output.write('\t'.join(['All Journals Combined', str(scores_at_percentiles[4]), str(ave)] + [str(x) for x in sorted(list(scores_at_percentiles) + list(boxplot_percentiles))] + [str(x) for x in pub_year_medians]) + '\n')
-    
+    for distribution_panel, year_panel, journals, journal_labels in get_figure_sets(registry):
+
+        # JOURNALS WITHOUT ANY PUBLICATIONS THAT PASS THE FILTERS ARE LEFT OUT OF THE FIGURES
+        journal_labels = [labels[key] for key in journals if key in journal_rates]
+        journals = [key for key in journals if key in journal_rates]
+        fig_height = 4 + len(journals) / 5
+
+        if distribution_panel:
+            percentile_scores = [[journal_summary.loc[journal, x] for x in range(10, 100, 10)] for journal in journal_labels]    # LEAVE OUT 100 PERCENTILE MARK FROM PLOTS, SINCE VIOLIN EXTENDS TO MAX VALUE.
+            means = [journal_summary.loc[journal, 'Mean'] for journal in journal_labels]
+            boxplot_locs = [[journal_summary.loc[journal, 25], journal_summary.loc[journal, 75]] for journal in journal_labels]
+            max_val = journal_summary.loc[journal_labels, 100].max()
+            plot_maindistributions(violins, journal_labels, percentile_scores, means, boxplot_locs, max_val, distribution_panel, fig_height)
+
+        if year_panel:
+            median_df = year_summary[year_summary['Journal'].isin(journal_labels)]
+            years = sorted(set(median_df['Publication Year']))
+            plot_year_lineplot(median_df, years, journals, journal_labels, year_panel, fig_height)
+
+
+def update_shards(journal_rates, settings, shard_dir, num_workers):
+    """Map step: summarize every journal whose shard is missing or was computed from different input rows
+    or settings, with compute_shard() running in a pool of worker processes. Other shards are reused as
+    they are. The manifest of shard fingerprints is rewritten once all shards are up to date.
+    Returns:
+        None
+    """
+
+    os.makedirs(shard_dir, exist_ok=True)
+    fingerprints = {key:get_shard_fingerprint(key, journal_rates[key][0], journal_rates[key][1], settings) for key in journal_rates}
+    previous_fingerprints = load_manifest(shard_dir)
+    to_compute = [key for key in journal_rates if previous_fingerprints.get(key) != fingerprints[key] or not os.path.exists(os.path.join(get_shard_path(shard_dir, key), 'summary.parquet'))]
+    print('Recomputing ' + str(len(to_compute)) + ' of ' + str(len(journal_rates)) + ' shards.')
+
+    # SHARDS ABOUT TO BE RECOMPUTED ARE DROPPED FROM THE MANIFEST FIRST, SO AN INTERRUPTED RUN NEVER LEAVES A PARTLY WRITTEN SHARD MARKED AS CURRENT
+    write_manifest(shard_dir, {key:previous_fingerprints[key] for key in journal_rates if key in previous_fingerprints and key not in to_compute})
+
+    # LARGEST SHARDS ARE STARTED FIRST TO KEEP ALL WORKERS BUSY
+    tasks = sorted([(key, journal_rates[key][0], journal_rates[key][1], settings, get_shard_path(shard_dir, key)) for key in to_compute], key=lambda task: -len(task[2]))
+    if num_workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            pool.map(compute_shard, tasks, chunksize=1)
+    else:
+        for task in tasks:
+            compute_shard(task)
+
+    write_manifest(shard_dir, fingerprints)
+
+
+def compute_shard(task):
+    """Summarize the self-reference percentages of one journal and write them as a Parquet partition
+    (summary.parquet, yearly.parquet and violin.parquet in the shard's folder). Runs as a worker process
+    when shards are computed in parallel.
+    Returns:
+        key = journal key of the shard
+    """
+
+    key, years, values, settings, shard_path = task
+
+    # SORT THE SHARD'S VALUES ONCE. summarize_groups() KEEPS THEM SORTED WITHIN EACH YEAR.
+    order = np.argsort(values, kind='stable')
+    values, years = values[order], years[order]
+
+    scores, means, groups = summarize_groups(values, np.zeros(len(values), dtype=np.int64), 1, settings['percentiles'])
+    summary = pd.DataFrame(scores, columns=[str(x) for x in settings['percentiles']])
+    summary['Mean'] = means
+    summary['# of Publications'] = len(values)
+
+    unique_years, year_codes = np.unique(years, return_inverse=True)
+    scores, means, groups = summarize_groups(values, year_codes, len(unique_years), [50])
+    CIs = np.full((len(groups), 2), np.nan)
+    if settings['bootstrap_resamples'] > 0:
+        CIs = np.array([bootstrap_median((group, settings['bootstrap_resamples'], get_bootstrap_seed(settings['bootstrap_seed'], key, pub_year), settings['ci_level'], settings['bootstrap_memory_budget'])) for pub_year, group in zip(unique_years, groups)]).reshape(len(groups), 2)
+    yearly = pd.DataFrame({'Publication Year':unique_years,
+        '# of Publications':[len(group) for group in groups],
+        'Median Self-Reference Percentage':scores[:, 0],
+        'CI Lower Bound':CIs[:, 0],
+        'CI Upper Bound':CIs[:, 1]})
+
+    support, density = get_violin_curve(values, settings['violin_gridsize'])
+    violin = pd.DataFrame({'Support':support, 'Density':density if density is not None else np.nan})
+
+    os.makedirs(shard_path, exist_ok=True)
+    for name, df in (('summary', summary), ('yearly', yearly), ('violin', violin)):
+        file = os.path.join(shard_path, name + '.parquet')
+        df.to_parquet(file + '.tmp', index=False)
+        os.replace(file + '.tmp', file)
+
+    return key
+
+
+def load_shards(shard_dir, keys, labels):
+    """Reduce step: read the shards of the given journals and combine them into the summaries used for
+    the tables and figures.
+    Returns:
+        journal_summary = DataFrame with journal labels as the index, percentiles (as integers), 'Mean' and
+                '# of Publications' as columns
+        year_summary = DataFrame with 'Publication Year', 'Journal', '# of Publications', 'Median Self-Reference
+                Percentage', 'CI Lower Bound' and 'CI Upper Bound' columns, sorted by year and then by journal in
+                the order of keys
+        violins = dictionary with journal labels as keys and get_violin_curve() tuples as values
+    """
+
+    summaries = []
+    yearlies = []
+    violins = {}
+    for key_order, key in enumerate(keys):
+        shard_path = get_shard_path(shard_dir, key)
+
+        summary = pd.read_parquet(os.path.join(shard_path, 'summary.parquet'))
+        summary.index = [labels[key]]
+        summaries.append(summary)
+
+        yearly = pd.read_parquet(os.path.join(shard_path, 'yearly.parquet'))
+        yearly.insert(1, 'Journal', labels[key])
+        yearly['Key Order'] = key_order
+        yearlies.append(yearly)
+
+        violin = pd.read_parquet(os.path.join(shard_path, 'violin.parquet'))
+        density = violin['Density'].to_numpy()
+        violins[labels[key]] = (violin['Support'].to_numpy(), None if np.isnan(density).all() else density)
+
+    journal_summary = pd.concat(summaries)
+    journal_summary.columns = [int(column) if column.isdigit() else column for column in journal_summary.columns]
+    year_summary = pd.concat(yearlies).sort_values(['Publication Year', 'Key Order'], kind='stable').drop(columns='Key Order').reset_index(drop=True)
+
+    return journal_summary, year_summary, violins
+
+
+def get_shard_path(shard_dir, key):
+
+    return os.path.join(shard_dir, 'Journal=' + key)
+
+
+def get_shard_fingerprint(key, years, values, settings):
+    """Fingerprint the inputs of one shard (its publication years and self-reference percentages, in
+    TableS1 order, and the statistics settings), so later runs can tell whether the shard changed.
+    Returns:
+        fingerprint = SHA-1 hex digest
+    """
+
+    sha1 = hashlib.sha1((key + '\t' + repr(sorted(settings.items()))).encode())
+    sha1.update(np.ascontiguousarray(years, dtype='<i8').tobytes())
+    sha1.update(np.ascontiguousarray(values, dtype='<f8').tobytes())
+
+    return sha1.hexdigest()
+
+
+def load_manifest(shard_dir):
+
+    fingerprints = {}
+    file = os.path.join(shard_dir, 'manifest.tsv')
+    if not os.path.exists(file):
+        return fingerprints
+
+    h = open(file)
+    header = h.readline()
+    for line in h:
+        key, fingerprint = line.rstrip('\n').split('\t')
+        fingerprints[key] = fingerprint
+    h.close()
+
+    return fingerprints
+
+
+def write_manifest(shard_dir, fingerprints):
+
+    file = os.path.join(shard_dir, 'manifest.tsv')
+    output = open(file + '.tmp', 'w')
+    output.write('Journal\tFingerprint\n')
+    for key in fingerprints:
+        output.write(key + '\t' + fingerprints[key] + '\n')
     output.close()
+    os.replace(file + '.tmp', file)
 
-    
-def plot_maindistributions(plotting_df, journal_labels, percentile_scores, means, boxplot_locs, figure_panel, fig_height):
 
-    plotting_df['hue'] = [0 for x in range(len(plotting_df['Journal']))]
-    
-    for xval, journal in enumerate(journal_labels):
-        plotting_df['Journal'].append(journal)
-        plotting_df['hue'].append(1)
-        plotting_df['Self-Reference Percentage'].append(-1000)
-        plotting_df['Publication Year'].append(1950)
+def summarize_groups(values, group_codes, num_groups, percentiles):
+    """Calculate percentiles and means for every group from values that are already sorted (at least
+    within each group). A stable sort of the integer group codes puts each group's values in one contiguous,
+    still-sorted block. Percentiles use the same linear interpolation as scipy.stats.scoreatpercentile(),
+    and means are exact like statistics.mean(), so results match the per-group scipy and statistics calls.
+    Returns:
+        scores = (groups x percentiles) array of scores at each percentile (NaN for empty groups)
+        means = array with the mean of each group (NaN for empty groups)
+        groups = list with the sorted values of each group (views into one array)
+    """
+
+    sorted_values = values[np.argsort(group_codes, kind='stable')]
+    counts = np.bincount(group_codes, minlength=num_groups)
+    starts = np.cumsum(counts) - counts
+
+    # FRACTIONAL INDEX OF EACH PERCENTILE WITHIN EACH GROUP, INTERPOLATED BETWEEN THE TWO NEAREST SORTED VALUES
+    has_values = counts > 0
+    idx = np.asarray(percentiles, dtype=float)[np.newaxis, :] / 100. * (np.maximum(counts, 1) - 1)[:, np.newaxis]
+    lower = np.floor(idx).astype(int)
+    upper = np.where(lower == idx, lower, lower + 1)
+    lower_weight = (lower + 1) - idx
+    upper_weight = idx - lower
+    lower_vals = sorted_values[np.minimum(starts[:, np.newaxis] + lower, len(sorted_values) - 1)]
+    upper_vals = sorted_values[np.minimum(starts[:, np.newaxis] + upper, len(sorted_values) - 1)]
+    scores = np.where(lower == idx, lower_vals, (lower_vals * lower_weight + upper_vals * upper_weight) / (lower_weight + upper_weight))
+    scores[~has_values] = np.nan
+
+    groups = [sorted_values[start:start+count] for start, count in zip(starts, counts)]
+    means = np.array([get_exact_mean(group) if len(group) else np.nan for group in groups])
+
+    return scores, means, groups
+
+
+def get_exact_mean(values):
+    """Mean calculated from the exact sum of the values and rounded once, which gives the same result as
+    statistics.mean() in a fraction of the time for large arrays.
+    Returns:
+        mean = float
+    """
+
+    total = math.fsum(values)
+    residual = math.fsum(np.append(values, -total))    # ROUNDING ERROR LEFT IN total
+
+    return float((Fraction(total) + Fraction(residual)) / len(values))
+
+
+def get_violin_curve(sorted_values, gridsize=100):
+    """Gaussian KDE of one group evaluated between its minimum and maximum values (Scott's bandwidth),
+    the same curve that seaborn's violinplot() draws with cut=0.
+    Returns:
+        support = array of gridsize evenly spaced values
+        density = array of KDE densities at each support value (None if all values are identical)
+    """
+
+    support = np.linspace(sorted_values[0], sorted_values[-1], gridsize)
+    if sorted_values[0] == sorted_values[-1]:
+        return support, None
+
+    kde = stats.gaussian_kde(sorted_values, bw_method='scott', weights=np.ones(len(sorted_values)))
+
+    return support, kde(support)
+
+
+def get_bootstrap_seed(seed, key, pub_year):
+    """Random stream for bootstrapping one (journal, year) group, derived from the seed, the journal key
+    and the year, so a group's confidence interval does not depend on which other groups are analyzed.
+    Returns:
+        seed_sequence = numpy SeedSequence
+    """
+
+    key_code = int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], 'little')
+
+    return np.random.SeedSequence(seed, spawn_key=(key_code, int(pub_year)))
+
+
+def bootstrap_median(task):
+    """Percentile bootstrap of the median of one group, whose values are sorted. All resamples are drawn
+    as one (resamples x group size) array of random indices, split into chunks that stay within
+    memory_budget bytes. Because the values are sorted, the median of each resample is found by
+    partitioning its indices around the middle and looking up the middle index (and, for an even group
+    size, the largest index below it), which gives the same result as np.median() of the resampled values.
+    Returns:
+        lower_CI, upper_CI = percentiles of the resampled medians bounding the central ci_level %
+    """
+
+    values, n_resamples, seed, ci_level, memory_budget = task
+    rng = np.random.default_rng(seed)
+    n = len(values)
+
+    # SMALL INTEGER INDICES KEEP THE RANDOM DRAWS AND THE PARTITION FAST. THE PARTITION MAKES ONE COPY OF THE INDEX ARRAY.
+    index_dtype = np.uint16 if n <= 2**16 else np.int64
+    resamples_per_chunk = max(1, memory_budget // (2 * np.dtype(index_dtype).itemsize * n))
+    medians = np.empty(n_resamples)
+    for start in range(0, n_resamples, resamples_per_chunk):
+        num_resamples = min(resamples_per_chunk, n_resamples - start)
+        indices = np.partition(rng.integers(0, n, size=(num_resamples, n), dtype=index_dtype), n // 2, axis=1)
+        upper_middle = values[indices[:, n // 2]]
+        lower_middle = values[indices[:, :n // 2].max(axis=1)] if n % 2 == 0 else upper_middle
+        medians[start:start+num_resamples] = (lower_middle + upper_middle) / 2
+
+    lower_CI, upper_CI = np.percentile(medians, [(100 - ci_level) / 2, 100 - (100 - ci_level) / 2])
+
+    return lower_CI, upper_CI
+
+
+def write_bootstrap_table(file, year_summary, n_resamples, ci_level):
+
+    output = open(file, 'w')
+    output.write('\t'.join(['Journal', 'Publication Year', '# of Publications', 'Median Self-Reference Percentage', 'Bootstrap Resamples', 'Bootstrap ' + str(ci_level) + '% Confidence Interval Lower Bound', 'Bootstrap ' + str(ci_level) + '% Confidence Interval Upper Bound']) + '\n')
+    rows = zip(year_summary['Journal'], year_summary['Publication Year'], year_summary['# of Publications'], year_summary['Median Self-Reference Percentage'], year_summary['CI Lower Bound'], year_summary['CI Upper Bound'])
+    for journal, pub_year, num_pubs, median, lower_CI, upper_CI in rows:
+        output.write('\t'.join([journal.replace('\n', ' '), str(pub_year), str(num_pubs), str(median), str(n_resamples), str(lower_CI), str(upper_CI)]) + '\n')
+    output.close()
+
+
+def get_table_row(journal, journal_summary, year_summary, percentiles, table_years):
+    """Format one TableS3 row from the precomputed summaries.
+    Returns:
+        row = tab-separated line
+    """
+
+    scores = journal_summary.loc[journal]
+    journal_years = year_summary[year_summary['Journal'] == journal]
+    year_medians = dict(zip(journal_years['Publication Year'], journal_years['Median Self-Reference Percentage']))
+    pub_year_medians = [year_medians.get(pub_year, 'N/A') for pub_year in table_years]
+
+    return '\t'.join([journal.replace('\n', ' '), str(scores[50]), str(scores['Mean'])] + [str(scores[x]) for x in percentiles] + [str(x) for x in pub_year_medians]) + '\n'
+
     
-    max_val = max(plotting_df['Self-Reference Percentage'])
+def plot_maindistributions(violins, journal_labels, percentile_scores, means, boxplot_locs, max_val, figure_panel, fig_height):
+
     ax = plt.gca()
 
     colors = sns.color_palette('pastel')
     
-    sns.violinplot(x='Self-Reference Percentage', y='Journal', hue='hue', data=plotting_df, inner=None, palette=[colors[2]], width=1.0, split=True, cut=0, orient='h', order=journal_labels)
+    # HALF VIOLINS DRAWN FROM THE PRECOMPUTED KDE CURVES, SCALED AND OUTLINED LIKE seaborn's violinplot(split=True, cut=0):
+    # THE HIGHEST DENSITY ACROSS ALL JOURNALS SPANS HALF OF A ROW
+    color = sns.desaturate(colors[2], 0.75)
+    linecolor = [colorsys.rgb_to_hls(*color)[1] * 0.6] * 3
+    linewidth = 1.25 * plt.rcParams['patch.linewidth']
+    max_density = max([violins[journal][1].max() for journal in journal_labels if violins[journal][1] is not None])
+    for xval, journal in enumerate(journal_labels):
+        support, density = violins[journal]
+        if density is None:
+            plt.plot((support[0], support[0]), (xval-0.5, xval), color=linecolor, linewidth=linewidth)
+        else:
+            ax.fill_between(support, xval - density / max_density * 0.5, xval, facecolor=color, edgecolor=linecolor, linewidth=linewidth)
+
     for xval, journal in enumerate(journal_labels):
         for j, score in enumerate(percentile_scores[xval]):
             if j == 4:
@@ -126,10 +408,8 @@ def plot_maindistributions(plotting_df, journal_labels, percentile_scores, means
         ax = plt.gca()
         ax.add_patch(plt.Polygon(coords, color ='grey'))
     
-    ax.get_legend().remove()
-    
     plt.xticks(fontname='Arial', fontsize=12)
-    plt.yticks(fontname='Arial', fontsize=12)
+    plt.yticks(range(len(journal_labels)), journal_labels, fontname='Arial', fontsize=12)
     plt.xlabel('Percent Self-References', fontname='Arial', fontsize=12)
     plt.ylabel('Journal', fontname='Arial', fontsize=12)
     plt.xlim(0-5, max_val+5)
@@ -142,10 +422,14 @@ def plot_maindistributions(plotting_df, journal_labels, percentile_scores, means
     
 def plot_year_lineplot(df, years, journals, journal_labels, fig_panel, fig_height):
 
-    # FILTER OUT DUMMY VALUES THAT GET ADDED IN plot_maindistributions() (THESE GET ADDED GLOBALLY EVEN THOUGH THE ADDING IS PERFORMED WITHIN A FUNCTION)
-    df = df[df['Median Self-Reference Percentage'] > -1000]
-    
-    colors = sns.color_palette()
+    colors = sns.color_palette(None if len(journal_labels) <= 10 else 'husl', n_colors=len(journal_labels))
+
+    # SHADED BOOTSTRAP CONFIDENCE BANDS (WHEN CALCULATED) BEHIND EACH JOURNAL'S LINE
+    if 'CI Lower Bound' in df:
+        for i, journal in enumerate(journal_labels):
+            journal_df = df[df['Journal'] == journal]
+            plt.fill_between(journal_df['Publication Year'], journal_df['CI Lower Bound'], journal_df['CI Upper Bound'], color=colors[i], alpha=0.15, linewidth=0)
+
     sns.lineplot(x='Publication Year', y='Median Self-Reference Percentage', data=df, hue='Journal', palette=colors[:len(journal_labels)], hue_order=journal_labels)
     sns.scatterplot(x='Publication Year', y='Median Self-Reference Percentage', data=df, hue='Journal', palette=colors[:len(journal_labels)], hue_order=journal_labels)
     plt.xticks([x for x in years], labels=list(years), fontname='Arial', fontsize=12, rotation=45)
@@ -165,72 +449,49 @@ def plot_year_lineplot(df, years, journals, journal_labels, fig_panel, fig_heigh
     plt.close()
     
     
-def make_median_df(df, years, journal_labels):
-
-    median_df = {'Publication Year':[],
-        'Journal':[],
-        'Median Self-Reference Percentage':[]}
-    for year in years:
-        for journal in journal_labels:
-            df2 = df[df['Publication Year'] == year]
-            df3 = df2[df2['Journal'] == journal]
-            vals = list(df3['Self-Reference Percentage'])
-            if len(vals) == 0:
-                continue
-            med_selfref = stats.scoreatpercentile(vals, 50)
-            median_df['Publication Year'].append(year)
-            median_df['Median Self-Reference Percentage'].append(med_selfref)
-            median_df['Journal'].append(journal)
-            
-    return median_df
-    
-    
-def get_selfref_rates(minimum_references, pmid_to_year, df, journals, j_to_jlabel):
+def get_selfref_rates(minimum_references, pmid_to_year, journals):
+    """Read the self-reference estimates for the given journals, keeping publications with at least the
+    minimum number of references.
+    Returns:
+        journal_rates = dictionary with journal keys as keys (in the order of journals, skipping journals without
+                any publications) and (publication years, self-reference percentages) tuples of arrays as values
+    """
+
+    df = {journal:([], []) for journal in journals}
 
     h = open('TableS1_SelfReferencingRate_Estimates.tsv')
     header = h.readline()
 
     for line in h:
-        journal, pmid, authors, all_author_num_selfrefs, all_author_perc_selfrefs, max_author, num_selfrefs, total_refs, perc_selfrefs = line.rstrip().split('\t')
+        journal, pmid, authors, all_author_num_selfrefs, all_author_perc_selfrefs, max_author, num_selfrefs, total_refs, perc_selfrefs = line.rstrip().split('\t')[:9]    # EXACT-NAME COLUMNS (THE INITIAL-LEVEL COLUMNS FOLLOW)
         
         if pmid == '2269344':   # ONE PMID WAS MIS-ATTRIBUTED TO Nature, WHEN IT IS REALLY A FEBS Letters PUBLICATION
             continue
         
-        if journal not in journals:
+        if journal not in df:
             continue
             
-        journal_label = j_to_jlabel[journal]
         num_selfrefs, total_refs = int(num_selfrefs), int(total_refs)
         if total_refs < minimum_references:
             continue
 
         perc = num_selfrefs / total_refs * 100
-        df['Publication Year'].append( int(pmid_to_year[pmid]) )
-        df['Self-Reference Percentage'].append( perc )
-        df['Journal'].append(journal_label)
+        df[journal][0].append( int(pmid_to_year[pmid]) )
+        df[journal][1].append( perc )
         
     h.close()
     
-    return df
+    return {journal:(np.array(df[journal][0], dtype=np.int64), np.array(df[journal][1], dtype=float)) for journal in journals if df[journal][0]}
     
 
 def get_pub_year_df():
+    """Get the publication year of every PMID from the cached index built by read_FilteredPMIDs.get_pmid_index(),
+    which streams the CSV directly out of Filtered_PMIDs_AllJournals.zip.
+    Returns:
+        df = dictionary with PMIDs as keys and publication years (strings) as values
+    """
 
-    h = open('Filtered_PMIDs_AllJournals.csv')
-    header = h.readline()
-    
-    df = {}
-    for line in h:
-        items = line.rstrip().split(',')
-        year = items[3]
-        pmid = items[9]
-        if pmid == '':
-            continue
-        df[pmid] = year
-        
-    h.close()
-    
-    return df
+    return get_pmid_years()
 
 
 if __name__ == '__main__':
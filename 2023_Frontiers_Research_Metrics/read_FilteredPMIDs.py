@@ -0,0 +1,91 @@
+
+from functools import lru_cache
+import zipfile
+import csv
+import io
+import os
+
+pmids_file = 'Filtered_PMIDs_AllJournals.zip'
+
+@lru_cache(maxsize=None)
+def get_pmid_index(file=pmids_file):
+    """Read the filtered PMID list in a single pass, streaming the CSV straight out of the zip archive
+    (an already-extracted .csv file also works). Rows without a PMID are skipped. The result is cached,
+    so repeated calls (e.g. once per journal in QueryPubmed.py) do not re-read the file.
+    Do not modify the returned dictionaries.
+    Returns:
+        pmid_index = dictionary with PMIDs as keys and (journal, publication year) tuples as values
+        journal_year_pmids = multi-dimensional dictionary
+                1st dimension ---> journal titles (as written in the CSV) as keys
+                2nd dimension ---> publication years as keys, lists of PMIDs as values
+    """
+
+    archive, h = open_pmids_file(file)
+    reader = csv.reader(h)
+
+    # LOOK UP COLUMNS BY NAME (THE HEADER HAS ONE MORE COLUMN THAN THE DATA ROWS, SO ONLY THE LEADING COLUMNS ARE USED)
+    header = next(reader)
+    journal_col = header.index('Journal Title')
+    year_col = header.index('Year')
+    pmid_col = header.index('PMID')
+
+    pmid_index = {}
+    journal_year_pmids = {}
+    for items in reader:
+        pmid = items[pmid_col]
+        if pmid == '':
+            continue
+        journal = items[journal_col]
+        year = items[year_col]
+
+        pmid_index[pmid] = (journal, year)
+        journal_year_pmids.setdefault(journal, {}).setdefault(year, []).append(pmid)
+
+    h.close()
+    if archive:
+        archive.close()
+
+    return pmid_index, journal_year_pmids
+
+
+def open_pmids_file(file):
+    """Open the filtered PMID CSV as text, either directly or as the (only) CSV member of a zip archive.
+    Falls back to the extracted CSV when the zip archive is not present.
+    Returns:
+        archive = open ZipFile (None when reading a plain CSV file)
+        h = text file handle positioned at the header line
+    """
+
+    if not os.path.exists(file) and file.endswith('.zip') and os.path.exists(file[:-4] + '.csv'):
+        file = file[:-4] + '.csv'
+
+    if not zipfile.is_zipfile(file):
+        return None, open(file, newline='')
+
+    archive = zipfile.ZipFile(file)
+    member = [name for name in archive.namelist() if name.endswith('.csv')][0]
+    h = io.TextIOWrapper(archive.open(member), newline='')
+
+    return archive, h
+
+
+def get_journal_pmids(journal, file=pmids_file):
+    """Get all PMIDs for one journal from the cached index.
+    Returns:
+        pmids = set of PMIDs for the journal (all publication years)
+    """
+
+    journal_year_pmids = get_pmid_index(file)[1]
+
+    return set([pmid for year in journal_year_pmids.get(journal, {}) for pmid in journal_year_pmids[journal][year]])
+
+
+def get_pmid_years(file=pmids_file):
+    """Get the publication year of every PMID from the cached index.
+    Returns:
+        pmid_to_year = dictionary with PMIDs as keys and publication years (strings) as values
+    """
+
+    pmid_index = get_pmid_index(file)[0]
+
+    return {pmid:pmid_index[pmid][1] for pmid in pmid_index}
@@ -0,0 +1,80 @@
+
+from read_FilteredPMIDs import get_pmid_index
+
+registry_file = 'Journal_Registry.tsv'
+registry_columns = ['Journal', 'PubMed Journal Title', 'Label', 'Distribution Panel', 'Yearly Median Panel']
+
+def get_journal_registry(file=registry_file, include_all_journals=False):
+    """Read the journal registry. Each row gives a journal's key (used in output file names and in the
+    Journal column of TableS1), its title in the filtered PMID list, its label in tables and figures
+    ('\\n' marks a line break) and, optionally, the figure panels it is plotted in. Journals are kept
+    in file order, which is also their order within each figure.
+    With include_all_journals, every other journal in the filtered PMID list is added after the
+    registered ones (see add_unregistered_journals()).
+    Returns:
+        registry = list of dictionaries (one per journal) with registry_columns as keys
+    """
+
+    h = open(file)
+    header = h.readline().rstrip('\n').split('\t')
+
+    registry = []
+    for line in h:
+        if line.strip() == '' or line.startswith('#'):
+            continue
+        items = line.rstrip('\n').split('\t')
+        entry = dict(zip(header, items + [''] * (len(header) - len(items))))
+        entry['Label'] = entry['Label'].replace('\\n', '\n')
+        registry.append(entry)
+
+    h.close()
+
+    if include_all_journals:
+        registry = add_unregistered_journals(registry)
+
+    return registry
+
+
+def add_unregistered_journals(registry):
+    """Add every journal in the filtered PMID list that is not in the registry yet. New journals are keyed
+    by the letters and digits of their title, labelled with their title and not assigned to any figure.
+    Returns:
+        registry = registry with the new journals appended in alphabetical order of title
+    """
+
+    registered_titles = set([entry['PubMed Journal Title'] for entry in registry])
+    keys = set([entry['Journal'] for entry in registry])
+    registry = list(registry)
+
+    for title in sorted(get_pmid_index()[1]):
+        if title in registered_titles:
+            continue
+        key = ''.join([char for char in title if char.isalnum()])
+        while key in keys:
+            key += '_'
+        keys.add(key)
+        registry.append({'Journal':key, 'PubMed Journal Title':title, 'Label':title, 'Distribution Panel':'', 'Yearly Median Panel':''})
+
+    return registry
+
+
+def get_figure_sets(registry):
+    """Group the registered journals by the figure panels they are plotted in. Journals without
+    figure panels are left out.
+    Returns:
+        figure_sets = list of (distribution panel, yearly median panel, journal keys, journal labels)
+                tuples, in order of each panel pair's first appearance in the registry
+    """
+
+    panels = []
+    journals = {}
+    for entry in registry:
+        panel_tup = (entry['Distribution Panel'], entry['Yearly Median Panel'])
+        if panel_tup == ('', ''):
+            continue
+        if panel_tup not in journals:
+            panels.append(panel_tup)
+            journals[panel_tup] = []
+        journals[panel_tup].append(entry)
+
+    return [(panel_tup[0], panel_tup[1], [entry['Journal'] for entry in journals[panel_tup]], [entry['Label'] for entry in journals[panel_tup]]) for panel_tup in panels]
@@ -0,0 +1,238 @@
+
+import http.server
+import urllib.parse
+import xml.etree.ElementTree as ET
+import threading
+import random
+import time
+import os
+
+efetch_header = '<?xml version="1.0" ?>\n<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2019//EN" "https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_190101.dtd">\n<PubmedArticleSet>\n'
+efetch_footer = '</PubmedArticleSet>\n'
+elink_header = '<?xml version="1.0" encoding="UTF-8" ?>\n<!DOCTYPE eLinkResult PUBLIC "-//NLM//DTD elink 20101123//EN" "https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20101123/elink.dtd">\n<eLinkResult>\n'
+elink_footer = '</eLinkResult>\n'
+
+def main():
+
+    # LOCAL STAND-IN FOR THE efetch AND elink E-UTILITIES. POINT base_url IN QueryPubmed.py AT http://127.0.0.1:<port>/ TO USE IT.
+    port = 8000
+    settings = get_default_settings()
+
+    # OPTIONAL FOLDER OF RECORDED XML FIXTURES (SEE record_fixtures()). PMIDs WITHOUT A FIXTURE GET A SYNTHETIC RECORD.
+    settings['fixture_dir'] = None
+
+    server = start_server(port, settings)
+    print('Mock E-utilities server listening on http://127.0.0.1:' + str(port) + '/')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+    print_server_stats(server)
+
+
+def get_default_settings():
+    """Default behavior of the mock server. Latencies are in seconds, rates are fractions of requests.
+    Returns:
+        settings = dictionary of mock server settings
+    """
+
+    settings = {'latency':0.05,            # MINIMUM TIME TO ANSWER A REQUEST
+        'latency_jitter':0.05,              # MEAN OF AN EXPONENTIAL DELAY ADDED TO EACH RESPONSE (GIVES A LONG TAIL)
+        'error_rate':0.01,                  # FRACTION OF REQUESTS ANSWERED WITH HTTP 500/502/503
+        'rate_limit':10,                    # REQUESTS PER SECOND ALLOWED BEFORE ANSWERING WITH HTTP 429 (None TO DISABLE)
+        'mean_authors':6,
+        'mean_references':40,
+        'no_references_rate':0.05,          # FRACTION OF ARTICLES WITHOUT A REFERENCE LIST
+        'reference_pool_size':200000,       # REFERENCES ARE DRAWN FROM PMIDs 1..reference_pool_size, SO POPULAR PMIDs ARE SHARED
+        'author_name_pool_size':5000,       # SMALLER POOLS GIVE MORE AUTHOR OVERLAP (SELF-REFERENCES)
+        'seed':0,
+        'fixture_dir':None}
+
+    return settings
+
+
+def start_server(port, settings):
+    """Start the mock server in a background thread.
+    Returns:
+        server = running ThreadingHTTPServer (call server.shutdown() to stop it)
+    """
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MockEutilitiesHandler)
+    server.daemon_threads = True
+    server.settings = settings
+    server.stats = {'requests':0, 'throttled':0, 'errors':0, 'efetch_ids':0, 'elink_ids':0}
+    server.stats_lock = threading.Lock()
+    server.request_times = []
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def print_server_stats(server):
+
+    stats = server.stats
+    print('Requests:', stats['requests'], 'Throttled (429):', stats['throttled'], 'Errors (5xx):', stats['errors'], 'efetch IDs:', stats['efetch_ids'], 'elink IDs:', stats['elink_ids'])
+
+
+class MockEutilitiesHandler(http.server.BaseHTTPRequestHandler):
+    """Answers GET and POST requests for efetch.fcgi and elink.fcgi like NCBI's E-utilities."""
+
+    def log_message(self, format, *args):
+        return
+
+    def do_GET(self):
+        self.answer(urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.answer(urllib.parse.parse_qs(self.rfile.read(length).decode()))
+
+    def answer(self, params):
+        server = self.server
+        settings = server.settings
+        utility = urllib.parse.urlsplit(self.path).path.rstrip('/').split('/')[-1]
+
+        with server.stats_lock:
+            server.stats['requests'] += 1
+            now = time.monotonic()
+            server.request_times = [t for t in server.request_times if now - t < 1] + [now]
+            throttled = settings['rate_limit'] is not None and len(server.request_times) > settings['rate_limit']
+            if throttled:
+                server.stats['throttled'] += 1
+
+        # NCBI ANSWERS REQUESTS OVER THE RATE LIMIT RIGHT AWAY WITH HTTP 429
+        if throttled:
+            self.send_body(429, b'{"error":"API rate limit exceeded"}', 'application/json', {'Retry-After':'1'})
+            return
+
+        time.sleep(settings['latency'] + random.expovariate(1 / settings['latency_jitter']) if settings['latency_jitter'] else settings['latency'])
+
+        if random.random() < settings['error_rate']:
+            with server.stats_lock:
+                server.stats['errors'] += 1
+            self.send_body(random.choice([500, 502, 503]), b'Internal Server Error', 'text/plain')
+            return
+
+        pmids = [pmid for value in params.get('id', []) for pmid in value.split(',') if pmid.strip()]
+        if utility == 'efetch.fcgi':
+            with server.stats_lock:
+                server.stats['efetch_ids'] += len(pmids)
+            body = efetch_header + ''.join([get_article_xml(pmid.strip(), settings) for pmid in pmids]) + efetch_footer
+        elif utility == 'elink.fcgi':
+            # SEPARATE id PARAMETERS GET ONE LinkSet EACH. COMMA-SEPARATED IDs WOULD BE MERGED INTO ONE LinkSet BY NCBI.
+            with server.stats_lock:
+                server.stats['elink_ids'] += len(pmids)
+            body = elink_header + ''.join([get_linkset_xml(value.strip(), settings) for value in params.get('id', [])]) + elink_footer
+        else:
+            self.send_body(404, b'Unknown E-utility', 'text/plain')
+            return
+
+        self.send_body(200, body.encode(), 'text/xml; charset=UTF-8')
+
+    def send_body(self, code, body, content_type, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key in headers:
+            self.send_header(key, headers[key])
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def get_article_xml(pmid, settings):
+    """Return the PubmedArticle record for a PMID, either from the recorded fixtures or generated
+    deterministically from the PMID and seed.
+    Returns:
+        xml = PubmedArticle element as a string
+    """
+
+    fixture = get_fixture(settings['fixture_dir'], 'efetch', pmid)
+    if fixture is not None:
+        return fixture
+
+    rng = random.Random(str(settings['seed']) + 'efetch' + pmid)
+    num_authors = 1 + int(rng.expovariate(1 / max(settings['mean_authors'] - 1, 1e-9)))
+    authors = []
+    for i in range(num_authors):
+        name_id = rng.randrange(settings['author_name_pool_size'])
+        forename = 'Author' + str(name_id % 97) + ' ' + chr(65 + name_id % 26)
+        initials = 'A' + chr(65 + name_id % 26)
+        authors.append('<Author ValidYN="Y"><LastName>Lastname' + str(name_id) + '</LastName><ForeName>' + forename + '</ForeName><Initials>' + initials + '</Initials></Author>')
+
+    return '<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">' + pmid + '</PMID><Article PubModel="Print"><ArticleTitle>Mock article ' + pmid + '</ArticleTitle><AuthorList CompleteYN="Y">' + ''.join(authors) + '</AuthorList></Article></MedlineCitation></PubmedArticle>\n'
+
+
+def get_linkset_xml(pmid, settings):
+    """Return the pubmed_pubmed_refs LinkSet for a PMID, either from the recorded fixtures or
+    generated deterministically from the PMID and seed.
+    Returns:
+        xml = LinkSet element as a string
+    """
+
+    fixture = get_fixture(settings['fixture_dir'], 'elink', pmid)
+    if fixture is not None:
+        return fixture
+
+    rng = random.Random(str(settings['seed']) + 'elink' + pmid)
+    links = ''
+    if rng.random() >= settings['no_references_rate']:
+        num_refs = 1 + int(rng.expovariate(1 / max(settings['mean_references'] - 1, 1e-9)))
+        # POPULAR (LOW) PMIDs ARE CITED MORE OFTEN, SO REFERENCES OVERLAP BETWEEN CITING ARTICLES
+        ref_pmids = sorted(set([1 + int(settings['reference_pool_size'] * rng.random()**2) for i in range(num_refs)]), reverse=True)
+        links = '<LinkSetDb><DbTo>pubmed</DbTo><LinkName>pubmed_pubmed_refs</LinkName>' + ''.join(['<Link><Id>' + str(ref_pmid) + '</Id></Link>' for ref_pmid in ref_pmids]) + '</LinkSetDb>'
+
+    return '<LinkSet><DbFrom>pubmed</DbFrom><IdList><Id>' + pmid + '</Id></IdList>' + links + '</LinkSet>\n'
+
+
+def get_fixture(fixture_dir, utility, pmid):
+
+    if not fixture_dir:
+        return None
+    file = os.path.join(fixture_dir, utility, pmid + '.xml')
+    if not os.path.exists(file):
+        return None
+
+    h = open(file, encoding='utf-8')
+    fixture = h.read()
+    h.close()
+
+    return fixture
+
+
+def record_fixtures(pmids, fixture_dir, eutils, pmids_per_request=200):
+    """Record real efetch and elink responses for a list of PMIDs (e.g. with an eutils session from
+    QueryPubmed.make_eutils_session() pointed at NCBI), split into one fixture file per PMID and utility.
+    Returns:
+        None
+    """
+
+    from QueryPubmed import query_eutils
+
+    for utility in ('efetch', 'elink'):
+        os.makedirs(os.path.join(fixture_dir, utility), exist_ok=True)
+
+    for i in range(0, len(pmids), pmids_per_request):
+        batch = pmids[i:i+pmids_per_request]
+
+        root = ET.fromstring(query_eutils(eutils, 'efetch', {'db':'pubmed', 'id':','.join(batch), 'retmode':'xml'}))
+        for article in root.findall('PubmedArticle'):
+            write_fixture(fixture_dir, 'efetch', article.findtext('MedlineCitation/PMID'), article)
+
+        root = ET.fromstring(query_eutils(eutils, 'elink', {'db':'pubmed', 'dbfrom':'pubmed', 'LinkName':'pubmed_pubmed_refs', 'id':batch}))
+        for linkset in root.findall('LinkSet'):
+            write_fixture(fixture_dir, 'elink', linkset.findtext('IdList/Id'), linkset)
+
+
+def write_fixture(fixture_dir, utility, pmid, element):
+
+    element.tail = '\n'
+    output = open(os.path.join(fixture_dir, utility, pmid + '.xml'), 'w', encoding='utf-8')
+    output.write(ET.tostring(element, encoding='unicode'))
+    output.close()
+
+
+if __name__ == '__main__':
+    main()
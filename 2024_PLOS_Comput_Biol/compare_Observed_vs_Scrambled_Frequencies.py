@@ -1,7 +1,11 @@
 
-from scipy.stats import fisher_exact
-import math
-import mpmath
+from scipy.stats import hypergeom
+import numpy as np
+import multiprocessing
+import os
+import json
+import hashlib
+import gzip
 
 # CREATE LIST OF STRINGS FOR ALL 400 LCD CLASSES
 amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
@@ -11,201 +15,680 @@ for res1 in amino_acids:
         if res1 == res2:
             continue
         aa_strings.append(res1+res2)
+
+# COLUMNS OF THE FISHER'S EXACT TEST RESULTS FILE
+output_columns = ['Proteome', 'Domain of Life', 'LCD Class', '# of Proteins with LCDs, Actual Proteome ("Observed")', '# of Proteins with LCDs, Scrambled Proteome', 'Total Proteins in Proteome', 'OddsRatio', 'lnOR', 'Fold Change (# in actual proteome / # in scrambled proteome)', '95% Confidence Interval (lower bound, upper bound)', '95% Confidence Interval for Odds Ratio Excludes 1?', 'p-value', 'Sidak-Holm Corrected p-value', 'Biased OddsRatio', 'Biased lnOR (when necessary)', 'Biased Fold Change [(# in actual proteome + 1) / (# in scrambled proteome + 1)]', 'Biased 95% Confidence Interval (lower bound, upper bound)', 'Biased Raw p-value (when necessary)']
         
 def main():
 
+    # SET TO A DIRECTORY NAME (e.g. '.lcd_frequency_cache') TO CACHE THE PARSED FREQUENCY TABLES AS .npy FILES BETWEEN RUNS
+    cache_dir = None
+
     # GET LCD FREQUENCY DATA
-    obs_df, org_to_domain = get_frequencies('TableS1_LCDfrequency_NumberOfProtsWithLCDs_Humans_Malaria_Only.tsv')
-    scr_df, org_to_domain_scr = get_frequencies('TableS1_LCDfrequency_NumberOfProtsWithLCDs_SCRAMBLED_Humans_Malaria_Only.tsv')
+    obs_freqs, obs_index, obs_domains = get_frequencies('TableS1_LCDfrequency_NumberOfProtsWithLCDs_Humans_Malaria_Only.tsv', cache_dir)
+    scr_freqs, scr_index, scr_domains = get_frequencies('TableS1_LCDfrequency_NumberOfProtsWithLCDs_SCRAMBLED_Humans_Malaria_Only.tsv', cache_dir)
 
-    # PREP OUTPUT FILE
-    output = open('Observed_vs_Scrambled_FisherExact_Results.tsv', 'w')
-    output.write('\t'.join(['Proteome', 'Domain of Life', 'LCD Class', '# of Proteins with LCDs, Actual Proteome ("Observed")', '# of Proteins with LCDs, Scrambled Proteome', 'Total Proteins in Proteome', 'OddsRatio', 'lnOR', 'Fold Change (# in actual proteome / # in scrambled proteome)', '95% Confidence Interval (lower bound, upper bound)', '95% Confidence Interval for Odds Ratio Excludes 1?', 'p-value', 'Sidak-Holm Corrected p-value', 'Biased OddsRatio', 'Biased lnOR (when necessary)', 'Biased Fold Change [(# in actual proteome + 1) / (# in scrambled proteome + 1)]', 'Biased 95% Confidence Interval (lower bound, upper bound)', 'Biased Raw p-value (when necessary)']) + '\n')
-    
-    # LOOP OVER PROTEOMES TO MAKE PLOTS FOR
-    for proteome in obs_df:
-        scr_label = proteome + '_SCRAMBLED'
-        if scr_label in scr_df:
-            pvals = []
-            lcd_classes = []
-
-            data_df = {}
-            biased_df = {}
-            domain = org_to_domain[proteome]
-            
-            # LOOP OVER 400 LCD CLASSES
-            for lcd_class in aa_strings:
-                obs = obs_df[proteome][lcd_class]
-                scr = scr_df[scr_label][lcd_class]
-                total_prots_obs = obs_df[proteome]['Total Proteins']
-                total_prots_scr = scr_df[scr_label]['Total Proteins']
-                
-                # INITIALIZE BIAS VARIABLES AS N/A (CASES IN WHICH BIASED ESTIMATES ARE NOT NECESSARY)
-                biased_oddsratio, biased_lnOR, biased_upper_CI, biased_lower_CI, biased_pval = ['N/A']*5
-                
-                if obs == 0 and scr == 0:   # NEED BIASED ESTIMATES DUE TO ZEROS
-                    data_line = [str(x) for x in (proteome, domain, lcd_class, obs, scr, total_prots_obs)] + ['N/A']*6
-                    data_df[lcd_class] = data_line
-                    biased_oddsratio, biased_lnOR, biased_upper_CI, biased_lower_CI, biased_pval = calc_lnOR(obs+1, total_prots_obs+1, scr+1, total_prots_scr+1, proteome)
-                    biased_fold_change = (obs+1) / (scr+1)
-                    if biased_oddsratio == 'N/A':
-                        biased_ci = 'N/A'
-                    else:
-                        biased_ci = (biased_lower_CI, biased_upper_CI)
-                
-                    biased_df[lcd_class] = [str(x) for x in (biased_oddsratio, biased_lnOR, biased_fold_change, biased_ci, biased_pval)]
+    # GATHER COUNTS FOR ALL PROTEOMES THAT HAVE A SCRAMBLED COUNTERPART INTO (PROTEOMES x 400) ARRAYS
+    proteomes = [proteome for proteome in obs_index if proteome + '_SCRAMBLED' in scr_index]
+    obs_rows = [obs_index[proteome] for proteome in proteomes]
+    scr_rows = [scr_index[proteome + '_SCRAMBLED'] for proteome in proteomes]
+    domains = [str(domain) for domain in obs_domains[obs_rows]]
+    obs_counts = np.asarray(obs_freqs[obs_rows, 1:], dtype=np.int64)
+    scr_counts = np.asarray(scr_freqs[scr_rows, 1:], dtype=np.int64)
+    obs_totals = np.asarray(obs_freqs[obs_rows, :1], dtype=np.int64)
+    scr_totals = np.asarray(scr_freqs[scr_rows, :1], dtype=np.int64)
 
-                    continue
+    # PARALLELIZATION SETTINGS: PROTEOMES ARE SPLIT INTO SHARDS, AND EACH SHARD IS PROCESSED BY ONE WORKER IN THE POOL
+    num_workers = 1
+    proteomes_per_shard = 250
 
-                # CALCULATE ODDS RATIO AND CONFIDENCE INTERVALS
-                oddsratio, lnOR, upper_CI, lower_CI, pval = calc_lnOR(obs, total_prots_obs, scr, total_prots_scr, proteome)
+    # OUTPUT SETTINGS: ROWS ARE STREAMED THROUGH A LARGE WRITE BUFFER. ADD 'gz' AND/OR 'parquet' TO extra_formats TO ALSO
+    # WRITE A GZIP-COMPRESSED COPY AND/OR A PARQUET COPY (REQUIRES pyarrow) OF THE RESULTS ALONGSIDE THE TSV FILE
+    output_file = 'Observed_vs_Scrambled_FisherExact_Results.tsv'
+    extra_formats = []
+    write_buffer_size = 1 << 20
 
-                if upper_CI != 'N/A' and lower_CI != 'N/A':
-                    is_in_CI = 0
-                    if lower_CI <= 0 <= upper_CI:
-                        is_in_CI = 1
-                else:
-                    is_in_CI = 'N/A'
-
-                if obs == 0 or scr == 0:    # FOR BIASED ESTIMATES
-                    fold_change = 'N/A'
-                    biased_oddsratio, biased_lnOR, biased_upper_CI, biased_lower_CI, biased_pval = calc_lnOR(obs+1, total_prots_obs+1, scr+1, total_prots_scr+1, proteome)
-                    biased_fold_change = (obs+1) / (scr+1)
-                else:   # FOR NON-BIASED ESTIMATES
-                    fold_change = obs / scr
-                    biased_fold_change = 'N/A'
-
-                if oddsratio == 'N/A':
-                    ci = 'N/A'
-                else:
-                    ci = (lower_CI, upper_CI)
+    # OPTIONAL PARAMETRIC BOOTSTRAP CONFIDENCE INTERVALS FOR lnOR. SET bootstrap_resamples ABOVE 0 TO ENABLE. RESULTS ARE
+    # WRITTEN TO A SEPARATE FILE. bootstrap_memory_budget LIMITS THE SIZE (IN BYTES) OF THE RESAMPLED ARRAYS HELD AT ONCE
+    bootstrap_resamples = 0
+    bootstrap_seed = None
+    bootstrap_memory_budget = 512 * 1024**2
+    bootstrap_file = 'Observed_vs_Scrambled_Bootstrap_lnOR_ConfidenceIntervals.tsv'
+
+    # SET TO True TO ONLY RECOMPUTE PROTEOMES WHOSE COUNTS CHANGED SINCE THE LAST RUN. RESULTS FOR UNCHANGED PROTEOMES ARE
+    # COPIED FROM THE PREVIOUS OUTPUT FILE, USING THE FINGERPRINTS STORED IN ITS INDEX FILE
+    incremental = False
+
+    fingerprints = get_fingerprints(domains, obs_counts, obs_totals, scr_counts, scr_totals)
+    previous_blocks = {}
+    if incremental:
+        previous_blocks = load_previous_blocks(output_file)
+    to_compute = [p for p, proteome in enumerate(proteomes) if proteome not in previous_blocks or previous_blocks[proteome][0] != fingerprints[p]]
+    if incremental:
+        print('Recomputing ' + str(len(to_compute)) + ' of ' + str(len(proteomes)) + ' proteomes.')
+
+    shards = []
+    for shard_num, start in enumerate(range(0, len(to_compute), proteomes_per_shard)):
+        rows = to_compute[start:start + proteomes_per_shard]
+        shard_file = output_file + '.part' + str(shard_num)
+        shards.append((shard_file, [proteomes[p] for p in rows], [domains[p] for p in rows], obs_counts[rows], obs_totals[rows], scr_counts[rows], scr_totals[rows], write_buffer_size))
+
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            shard_results = pool.map(compare_shard, shards, chunksize=1)
+    else:
+        shard_results = [compare_shard(shard) for shard in shards]
+
+    # MERGE NEW AND REUSED BLOCKS IN THE ORIGINAL PROTEOME ORDER
+    merge_shards(shard_results, output_file, extra_formats, write_buffer_size, proteomes, fingerprints, previous_blocks, proteomes_per_shard)
+
+    # RESAMPLE EACH GROUP OF PROTEOMES WITH ITS OWN INDEPENDENT RANDOM STREAM, SO RESULTS DEPEND ONLY ON THE SEED AND NOT ON num_workers
+    if bootstrap_resamples > 0:
+        shards = [(proteomes[start:start + proteomes_per_shard], domains[start:start + proteomes_per_shard]) for start in range(0, len(proteomes), proteomes_per_shard)]
+        seeds = np.random.SeedSequence(bootstrap_seed).spawn(len(shards))
+        bootstrap_shards = [(obs_counts[rows], obs_totals[rows], scr_counts[rows], scr_totals[rows], bootstrap_resamples, seeds[i], bootstrap_memory_budget) for i, rows in enumerate(slice(start, start + proteomes_per_shard) for start in range(0, len(proteomes), proteomes_per_shard))]
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers) as pool:
+                bootstrap_results = pool.map(bootstrap_shard, bootstrap_shards, chunksize=1)
+        else:
+            bootstrap_results = [bootstrap_shard(shard) for shard in bootstrap_shards]
+
+        output = open(bootstrap_file, 'w', newline='\n')
+        output.write('\t'.join(['Proteome', 'Domain of Life', 'LCD Class', 'Bootstrap Resamples', 'Bootstrap Median lnOR', 'Bootstrap 95% Confidence Interval (lower bound, upper bound)']) + '\n')
+        for shard, (medians, lower_CIs, upper_CIs) in zip(shards, bootstrap_results):
+            medians, lower_CIs, upper_CIs = medians.tolist(), lower_CIs.tolist(), upper_CIs.tolist()
+            for p, proteome in enumerate(shard[0]):
+                output.write(''.join(['\t'.join([proteome, shard[1][p], lcd_class, str(bootstrap_resamples), str(medians[p][i]), str((lower_CIs[p][i], upper_CIs[p][i]))]) + '\n' for i, lcd_class in enumerate(aa_strings)]))
+        output.close()
+
+
+def bootstrap_shard(shard):
+    """Run the lnOR bootstrap for one shard of proteomes. Runs as a worker process when
+    the comparison is parallelized.
+    Returns:
+        medians, lower_CI, upper_CI = (proteomes x 400) arrays, see bootstrap_lnOR
+    """
+    obs_counts, obs_totals, scr_counts, scr_totals, n_resamples, seed, memory_budget = shard
+    rng = np.random.default_rng(seed)
+
+    return bootstrap_lnOR(obs_counts, obs_totals, scr_counts, scr_totals, n_resamples, rng, memory_budget)
+
+
+def bootstrap_lnOR(obs, total_prots_obs, scr, total_prots_scr, n_resamples, rng, memory_budget):
+    """Parametric bootstrap of the lnOR for every proteome and LCD class. The # of proteins
+    with LCDs is redrawn from a binomial distribution for both the actual and the scrambled
+    proteome, and the lnOR of each resampled table is calculated with 0.5 added to every cell
+    (Haldane-Anscombe correction) so that resampled zeros still give a finite lnOR. Counts of 0
+    (or equal to the total) are redrawn with the pseudocount-smoothed proportion (x+0.5)/(total+1),
+    so those classes still vary between resamples instead of giving a zero-width interval.
+    Proteomes are processed in chunks sized so that the resampled arrays stay within memory_budget bytes.
+    Returns:
+        medians = (proteomes x 400) array of median bootstrap lnORs
+        lower_CI = (proteomes x 400) array of 2.5th percentile bootstrap lnORs
+        upper_CI = (proteomes x 400) array of 97.5th percentile bootstrap lnORs
+    """
+    obs, total_prots_obs, scr, total_prots_scr = [np.asarray(x, dtype=np.int64) for x in (obs, total_prots_obs, scr, total_prots_scr)]
+    percentiles = np.empty((3,) + obs.shape)
+
+    # AT MOST 4 ARRAYS OF 8-BYTE VALUES ARE HELD PER RESAMPLED CELL: THE 2 SETS OF DRAWS PLUS 2 FLOAT BUFFERS WHILE THE lnORs ARE
+    # CALCULATED IN PLACE, THEN THE lnORs AND THE COPY THAT np.percentile PARTITIONS
+    bytes_per_proteome = 4 * 8 * n_resamples * obs.shape[1]
+    proteomes_per_chunk = max(1, memory_budget // bytes_per_proteome)
+
+    # BINOMIAL PROPORTIONS, SMOOTHED WITH A PSEUDOCOUNT WHERE THE OBSERVED PROPORTION IS 0 OR 1
+    p_obs = np.where((obs == 0) | (obs == total_prots_obs), (obs + 0.5) / (total_prots_obs + 1), obs / total_prots_obs)
+    p_scr = np.where((scr == 0) | (scr == total_prots_scr), (scr + 0.5) / (total_prots_scr + 1), scr / total_prots_scr)
+
+    for start in range(0, obs.shape[0], proteomes_per_chunk):
+        rows = slice(start, start + proteomes_per_chunk)
+        obs_draws = rng.binomial(total_prots_obs[rows], p_obs[rows], size=(n_resamples,) + obs[rows].shape)
+        scr_draws = rng.binomial(total_prots_scr[rows], p_scr[rows], size=(n_resamples,) + scr[rows].shape)
+
+        # lnOR = log[(o+.5)(Ts-s+.5) / ((To-o+.5)(s+.5))], CALCULATED IN PLACE SO THAT NO OTHER TEMPORARY ARRAYS ARE CREATED
+        lnORs = np.add(obs_draws, 0.5)
+        buffer = np.subtract(total_prots_scr[rows] + 0.5, scr_draws)
+        lnORs *= buffer
+        np.subtract(total_prots_obs[rows] + 0.5, obs_draws, out=buffer)
+        lnORs /= buffer
+        np.add(scr_draws, 0.5, out=buffer)
+        lnORs /= buffer
+        del obs_draws, scr_draws, buffer
+        np.log(lnORs, out=lnORs)
+        percentiles[:, rows] = np.percentile(lnORs, [50, 2.5, 97.5], axis=0)
+
+    return percentiles[0], percentiles[1], percentiles[2]
+
+
+def merge_shards(shard_results, output_file, extra_formats, write_buffer_size, proteomes, fingerprints, previous_blocks, proteomes_per_parquet_group):
+    """Assemble the results file in proteome order from newly computed partial files and, in
+    incremental mode, from blocks of the previous results file that can be reused. Blocks are
+    copied one at a time, so memory use does not depend on the number of proteomes. Also writes
+    an index sidecar (<output_file>.idx) with the byte offset, byte length and input fingerprint
+    of each proteome's block of rows, and optionally writes gzip and/or Parquet copies of the
+    merged results in the same pass. The new files replace the old ones only once complete.
+    Returns:
+        None
+    """
+    sources = {}
+    for shard_file, blocks in shard_results:
+        for proteome, block_offset, block_length in blocks:
+            sources[proteome] = (shard_file, block_offset, block_length)
+    for proteome in proteomes:
+        if proteome not in sources:
+            fingerprint, block_offset, block_length = previous_blocks[proteome]
+            sources[proteome] = (output_file, block_offset, block_length)
+
+    outputs = [(output_file, open(output_file + '.tmp', 'wb', buffering=write_buffer_size))]
+    if 'gz' in extra_formats:
+        outputs.append((output_file + '.gz', gzip.open(output_file + '.gz.tmp', 'wb', compresslevel=6)))
+    header = ('\t'.join(output_columns) + '\n').encode()
+    for file, output in outputs:
+        output.write(header)
+
+    index_output = open(output_file + '.idx.tmp', 'w', newline='\n')
+    index_output.write('\t'.join(['Proteome', 'Byte Offset', 'Byte Length', 'Fingerprint']) + '\n')
+    offset = len(header)
+
+    parquet_writer = None
+    if 'parquet' in extra_formats:
+        import pyarrow as pa
+        import pyarrow.csv
+        import pyarrow.parquet
+        schema = pa.schema([(column, pa.string()) for column in output_columns])
+        parquet_file = os.path.splitext(output_file)[0] + '.parquet'
+        parquet_writer = pyarrow.parquet.ParquetWriter(parquet_file + '.tmp', schema)
+        parquet_blocks = []
+
+    handles = {}
+    for p, proteome in enumerate(proteomes):
+        source_file, block_offset, block_length = sources[proteome]
+        if source_file not in handles:
+            handles[source_file] = open(source_file, 'rb')
+        h = handles[source_file]
+        h.seek(block_offset)
+        block = h.read(block_length)
+
+        for file, output in outputs:
+            output.write(block)
+        index_output.write('\t'.join([proteome, str(offset), str(block_length), fingerprints[p]]) + '\n')
+        offset += block_length
+
+        # ALL PARQUET COLUMNS ARE STORED AS STRINGS SO THAT VALUES ARE IDENTICAL TO THE TSV FILE
+        if parquet_writer is not None:
+            parquet_blocks.append(block)
+            if len(parquet_blocks) == proteomes_per_parquet_group or p == len(proteomes) - 1:
+                table = pyarrow.csv.read_csv(pa.py_buffer(b''.join(parquet_blocks)), read_options=pyarrow.csv.ReadOptions(column_names=output_columns),
+                                             parse_options=pyarrow.csv.ParseOptions(delimiter='\t', quote_char=False),
+                                             convert_options=pyarrow.csv.ConvertOptions(column_types=schema, strings_can_be_null=False))
+                parquet_writer.write_table(table)
+                parquet_blocks = []
+
+    for h in handles.values():
+        h.close()
+    for file, output in outputs:
+        output.close()
+        os.replace(file + '.tmp', file)
+    index_output.close()
+    os.replace(output_file + '.idx.tmp', output_file + '.idx')
+    if parquet_writer is not None:
+        parquet_writer.close()
+        os.replace(parquet_file + '.tmp', parquet_file)
+
+    for shard_file, blocks in shard_results:
+        os.remove(shard_file)
+
+
+def get_fingerprints(domains, obs_counts, obs_totals, scr_counts, scr_totals):
+    """Calculate a fingerprint of the inputs for each proteome, so that incremental runs can
+    tell which proteomes changed since the results file was last written.
+    Returns:
+        fingerprints = list of SHA-1 hex digests, one per proteome
+    """
+    fingerprints = []
+    for p in range(len(domains)):
+        sha1 = hashlib.sha1(domains[p].encode())
+        for counts in (obs_counts[p], obs_totals[p], scr_counts[p], scr_totals[p]):
+            sha1.update(np.ascontiguousarray(counts, dtype='<i8').tobytes())
+        fingerprints.append(sha1.hexdigest())
+
+    return fingerprints
+
+
+def load_previous_blocks(output_file):
+    """Load the index of a previous results file for incremental runs. Blocks are only reused
+    if the index has fingerprints and agrees with the results file it describes.
+    Returns:
+        previous_blocks = dictionary with proteome IDs as keys and (fingerprint, byte offset, byte length) as values
+                          (empty if there is no usable previous results file)
+    """
+    previous_blocks = {}
+    if not os.path.exists(output_file) or not os.path.exists(output_file + '.idx'):
+        return previous_blocks
+
+    h = open(output_file + '.idx')
+    header = h.readline().rstrip('\n').split('\t')
+    if 'Fingerprint' not in header:
+        h.close()
+        return previous_blocks
+    for line in h:
+        proteome, offset, length, fingerprint = line.rstrip('\n').split('\t')
+        previous_blocks[proteome] = (fingerprint, int(offset), int(length))
+    h.close()
+
+    # CHECK THAT EVERY BLOCK STARTS WITH ITS PROTEOME AND THAT THE BLOCKS COVER THE WHOLE FILE
+    h = open(output_file, 'rb')
+    end = 0
+    for proteome, (fingerprint, offset, length) in previous_blocks.items():
+        h.seek(offset)
+        if h.read(len(proteome) + 1) != (proteome + '\t').encode():
+            h.close()
+            return {}
+        end = max(end, offset + length)
+    h.close()
+    if end != os.path.getsize(output_file):
+        return {}
+
+    return previous_blocks
+
+
+def compare_shard(shard):
+    """Run Fisher's exact tests and Sidak-Holm corrections for one shard of proteomes
+    and write the resulting rows (without a header) to a partial output file.
+    Runs as a worker process when the comparison is parallelized.
+    Returns:
+        shard_file = name of the partial output file
+        blocks = list of (proteome, byte offset, byte length) tuples for each proteome's rows within shard_file
+    """
+    shard_file, proteomes, domains, obs_counts, obs_totals, scr_counts, scr_totals, write_buffer_size = shard
+
+    # RUN ALL FISHER'S EXACT TESTS FOR THE SHARD IN ONE PASS, FOR BOTH THE ACTUAL AND THE BIASED (+1) ESTIMATES
+    unbiased_results = [nan_to_na(x) for x in calc_lnOR(obs_counts, obs_totals, scr_counts, scr_totals)]
+    biased_results = [nan_to_na(x) for x in calc_lnOR(obs_counts+1, obs_totals+1, scr_counts+1, scr_totals+1)]
+    obs_rows, scr_rows, obs_totals = obs_counts.tolist(), scr_counts.tolist(), obs_totals.tolist()
+
+    output = open(shard_file, 'w', buffering=write_buffer_size, newline='\n')
+    blocks = []
+    offset = 0
+    
+    # LOOP OVER PROTEOMES TO MAKE PLOTS FOR
+    for p, proteome in enumerate(proteomes):
+        pvals = []
+        pval_positions = []
+
+        data_lines = []
+        biased_lines = []
+        domain = domains[p]
+        total_prots_obs = obs_totals[p][0]
+        oddsratios, lnORs, upper_CIs, lower_CIs, raw_pvals = [x[p] for x in unbiased_results]
+        biased_oddsratios, biased_lnORs, biased_upper_CIs, biased_lower_CIs, biased_pvals = [x[p] for x in biased_results]
+        
+        # LOOP OVER 400 LCD CLASSES
+        for i, lcd_class in enumerate(aa_strings):
+            obs = obs_rows[p][i]
+            scr = scr_rows[p][i]
+            
+            # INITIALIZE BIAS VARIABLES AS N/A (CASES IN WHICH BIASED ESTIMATES ARE NOT NECESSARY)
+            biased_oddsratio, biased_lnOR, biased_upper_CI, biased_lower_CI, biased_pval = ['N/A']*5
+            
+            if obs == 0 and scr == 0:   # NEED BIASED ESTIMATES DUE TO ZEROS
+                data_line = [str(x) for x in (proteome, domain, lcd_class, obs, scr, total_prots_obs)] + ['N/A']*6
+                data_lines.append(data_line)
+                biased_oddsratio, biased_lnOR, biased_upper_CI, biased_lower_CI, biased_pval = biased_oddsratios[i], biased_lnORs[i], biased_upper_CIs[i], biased_lower_CIs[i], biased_pvals[i]
+                biased_fold_change = (obs+1) / (scr+1)
                 if biased_oddsratio == 'N/A':
                     biased_ci = 'N/A'
                 else:
                     biased_ci = (biased_lower_CI, biased_upper_CI)
-                    
-                # CREATE DATA STRING FOR OUTPUT
-                data_line = [str(x) for x in (proteome, domain, lcd_class, obs, scr, total_prots_obs, oddsratio, lnOR, fold_change, ci, is_in_CI, pval)]
+            
+                biased_lines.append([str(x) for x in (biased_oddsratio, biased_lnOR, biased_fold_change, biased_ci, biased_pval)])
 
-                data_df[lcd_class] = data_line
-                biased_df[lcd_class] = [str(x) for x in (biased_oddsratio, biased_lnOR, biased_fold_change, biased_ci, biased_pval)]
-                
-                if pval != 'N/A':
-                    pvals.append(pval)
-                    lcd_classes.append(lcd_class)
+                continue
+
+            # CALCULATE ODDS RATIO AND CONFIDENCE INTERVALS
+            oddsratio, lnOR, upper_CI, lower_CI, pval = oddsratios[i], lnORs[i], upper_CIs[i], lower_CIs[i], raw_pvals[i]
+
+            if upper_CI != 'N/A' and lower_CI != 'N/A':
+                is_in_CI = 0
+                if lower_CI <= 0 <= upper_CI:
+                    is_in_CI = 1
+            else:
+                is_in_CI = 'N/A'
+
+            if obs == 0 or scr == 0:    # FOR BIASED ESTIMATES
+                fold_change = 'N/A'
+                biased_oddsratio, biased_lnOR, biased_upper_CI, biased_lower_CI, biased_pval = biased_oddsratios[i], biased_lnORs[i], biased_upper_CIs[i], biased_lower_CIs[i], biased_pvals[i]
+                biased_fold_change = (obs+1) / (scr+1)
+            else:   # FOR NON-BIASED ESTIMATES
+                fold_change = obs / scr
+                biased_fold_change = 'N/A'
 
-            # CORRECT P-VALUES FOR MULTIPLE HYPOTHESIS TESTS
-            if len(pvals) == 0:
-                corrected_pvals = []
+            if oddsratio == 'N/A':
+                ci = 'N/A'
+            else:
+                ci = (lower_CI, upper_CI)
+            if biased_oddsratio == 'N/A':
+                biased_ci = 'N/A'
             else:
-                corrected_pvals = sidak_correction(pvals)
+                biased_ci = (biased_lower_CI, biased_upper_CI)
+                
+            # CREATE DATA STRING FOR OUTPUT
+            data_line = [str(x) for x in (proteome, domain, lcd_class, obs, scr, total_prots_obs, oddsratio, lnOR, fold_change, ci, is_in_CI, pval)]
+
+            data_lines.append(data_line)
+            biased_lines.append([str(x) for x in (biased_oddsratio, biased_lnOR, biased_fold_change, biased_ci, biased_pval)])
             
-            # PREPARE DATA FOR OUTPUT
-            for lcd_class in aa_strings:
-                if lcd_class in lcd_classes:
-                    index = lcd_classes.index(lcd_class)
-                    corrected_pval = corrected_pvals[index]
-                    data_df[lcd_class].append(str(corrected_pval))
-                else:
-                    data_df[lcd_class].append('N/A')
-                    
-                data_df[lcd_class] += biased_df[lcd_class]
-                output.write('\t'.join(data_df[lcd_class]) + '\n')
+            if pval != 'N/A':
+                pvals.append(pval)
+                pval_positions.append(i)
+
+        # CORRECT P-VALUES FOR MULTIPLE HYPOTHESIS TESTS
+        corrected_pvals = ['N/A'] * len(aa_strings)
+        if len(pvals) > 0:
+            for i, corrected_pval in zip(pval_positions, sidak_correction(pvals)):
+                corrected_pvals[i] = format_pval(corrected_pval)
+        
+        # FORMAT ALL 400 ROWS FOR THE PROTEOME, WRITE THEM IN ONE CALL, AND RECORD WHERE THE BLOCK STARTS FOR THE INDEX
+        block = ''.join(['\t'.join(data_lines[i] + [corrected_pvals[i]] + biased_lines[i]) + '\n' for i in range(len(aa_strings))])
+        output.write(block)
+        block_length = len(block.encode())
+        blocks.append((proteome, offset, block_length))
+        offset += block_length
                 
     output.close()
 
+    return shard_file, blocks
+
 
 def sidak_correction(pvals):
     """Performs multiple test correction using Sidak-Holm method.
+    The Sidak adjustment 1-(1-p)**k is computed in log space as -expm1(k*log1p(-p)),
+    which keeps full precision even for subnormal p-values (see tests/test_sidak_correction.py).
+    P-values that already underflowed to 0.0 stay 0.0. The calculation uses extended precision
+    (np.longdouble), so that rounding the results to 16 significant digits (format_pval) gives
+    the same digits as the original 300-digit mpmath implementation. On platforms where
+    np.longdouble is plain double precision, the 16th digit can occasionally differ.
     Returns:
-        final_pvals = list of corrected p-values, sorted in ascending order.
+        final_pvals = list of corrected p-values (np.longdouble), in the same order as pvals.
     """
     
-    positions = [i for i in range(len(pvals))]
-    sorted_pvals, pval_positions = zip(*sorted(zip(pvals, positions)))
+    pvals = np.asarray(pvals, dtype=np.longdouble)
     m = len(pvals)
+    order = np.argsort(pvals, kind='stable')
+    sorted_pvals = pvals[order]
+    exponents = np.arange(m, 0, -1).astype(np.longdouble)
 
-    mpmath.mp.dps = 300
+    with np.errstate(divide='ignore'):
+        corrected_pvals = -np.expm1(exponents * np.log1p(-sorted_pvals))
 
-    corrected_pvals = [1-(1-mpmath.mp.mpf(sorted_pvals[len(pvals)-i]))**(i) for i in range(m, 0, -1)]
+    # STEP-DOWN: CORRECTED P-VALUES CAN NEVER DECREASE AS THE RAW P-VALUES INCREASE
+    corrected_pvals = np.maximum.accumulate(corrected_pvals)
 
-    final_pvals = [corrected_pvals[0]]
-    for i in range(1, len(corrected_pvals)):
-        pval = max(final_pvals[-1], corrected_pvals[i])
-        final_pvals.append(pval)
-        
-    corrected_pvals = [corrected_pvals[0]] + [max(corrected_pvals[i-1], corrected_pvals[i]) for i in range(1, len(corrected_pvals))]
-    corrected_pvals = [mpmath.nstr(x, 16) for x in corrected_pvals]
-    final_pvals = [mpmath.nstr(x, 16) for x in final_pvals]
+    final_pvals = np.empty(m, dtype=np.longdouble)
+    final_pvals[order] = corrected_pvals
 
-    pval_positions, final_pvals = zip(*sorted(zip(pval_positions, final_pvals)))
+    return list(final_pvals)
 
-    return final_pvals
+
+def format_pval(pval):
+    """Format a corrected p-value with 16 significant digits, exactly as mpmath.nstr(x, 16) does
+    (fixed-point notation between 1e-5 and 1e16, trailing zeros removed, at least one decimal place),
+    so the results file keeps the format written by the original mpmath implementation.
+    Returns:
+        pval_string = formatted p-value
+    """
+    if pval == 0:
+        return '0.0'
+
+    mantissa, exponent = np.format_float_scientific(pval, precision=15, unique=False).split('e')
+    digits = mantissa.replace('.', '').rstrip('0')
+    exponent = int(exponent)
+    if -5 < exponent < 16:
+        if exponent < 0:
+            return '0.' + '0'*(-exponent-1) + digits
+        digits = digits.ljust(exponent + 1, '0')
+        return digits[:exponent+1] + '.' + (digits[exponent+1:] or '0')
+
+    return digits[0] + '.' + (digits[1:] or '0') + 'e' + str(exponent)
     
          
-def calc_lnOR(obs, total_prots_obs, scr, total_prots_scr, proteome):
-    """Calculate the natural log of the odds ratio for the LCD frequency for a given
-    LCD class in the original proteome versus scrambled proteome.
+def calc_lnOR(obs, total_prots_obs, scr, total_prots_scr):
+    """Calculate the natural log of the odds ratio for the LCD frequency for every
+    LCD class in the original proteome versus scrambled proteome. Inputs are NumPy
+    arrays (or scalars) that broadcast against one another, so all proteomes and
+    all 400 LCD classes can be evaluated in a single call.
     Returns:
-        oddsratio = float
-        lnOR = natural log of the odds ratio, float
-        upper_CI = upper bound on the 95% confidence interval, float
-        lower_CI = lower bound on the 95% confidence interval, float
-        pval = p-value from Fisher's exact test, float
+        oddsratio = array of odds ratios (NaN when not calculable)
+        lnOR = array of natural logs of the odds ratios (NaN when not calculable)
+        upper_CI = array of upper bounds on the 95% confidence intervals (NaN when not calculable)
+        lower_CI = array of lower bounds on the 95% confidence intervals (NaN when not calculable)
+        pval = array of p-values from Fisher's exact test
     """
-    contingency = [ [obs, (total_prots_obs-obs)], [scr, (total_prots_scr-scr)] ]
+    obs, total_prots_obs, scr, total_prots_scr = np.broadcast_arrays(*[np.asarray(x, dtype=np.int64) for x in (obs, total_prots_obs, scr, total_prots_scr)])
 
-    oddsratio, pval = fisher_exact(contingency, alternative='two-sided')
+    oddsratio, pval = batch_fisher_exact(obs, total_prots_obs-obs, scr, total_prots_scr-scr)
 
     # lnOR, oddsratio, AND CONFIDENCE INTERVALS CAN'T BE CALCULATED IF 
     # OBSERVED OR SCRAMBLED FREQUENCIES ARE ZERO. REQUIRES BIASED ESTIMATION, 
     # WHICH IS PERFORMED LATER.
-    if obs == 0 or scr == 0 or obs == total_prots_obs or scr == total_prots_scr:
-        lnOR = 'N/A'
-        upper_CI = 'N/A'
-        lower_CI = 'N/A'
-        oddsratio = 'N/A'
+    not_calculable = (obs == 0) | (scr == 0) | (obs == total_prots_obs) | (scr == total_prots_scr)
+    oddsratio = np.where(not_calculable, np.nan, oddsratio)
 
     # CASES WHERE BIASED ESTIMATION IS NOT NEEDED
-    else:
-        lnOR = math.log(oddsratio)
-        
-        upper_CI = lnOR + 1.96 * math.sqrt(1/obs + 1/total_prots_obs + 1/scr + 1/total_prots_scr)
-        lower_CI = lnOR - 1.96 * math.sqrt(1/obs + 1/total_prots_obs + 1/scr + 1/total_prots_scr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lnOR = np.log(oddsratio)
+        se = 1.96 * np.sqrt(1/obs + 1/total_prots_obs + 1/scr + 1/total_prots_scr)
+    upper_CI = np.where(not_calculable, np.nan, lnOR + se)
+    lower_CI = np.where(not_calculable, np.nan, lnOR - se)
 
     return oddsratio, lnOR, upper_CI, lower_CI, pval
-    
 
-def get_frequencies(file):
-    """Get LCD frequencies for each LCD class and organism.
+
+def batch_fisher_exact(a, b, c, d):
+    """Two-sided Fisher's exact test for many 2x2 tables [[a, b], [c, d]] at once.
+    Follows the same steps as scipy.stats.fisher_exact (mode check, tail sums and
+    binary search for the opposite tail), but evaluates the hypergeometric
+    functions on whole arrays, so results are identical to testing one table at a time.
+    Returns:
+        oddsratio = array of sample odds ratios (NaN if a row or column sums to zero)
+        pval = array of two-sided p-values
+    """
+    a, b, c, d = np.broadcast_arrays(*[np.asarray(x, dtype=np.int64) for x in (a, b, c, d)])
+    oddsratio = np.full(a.shape, np.nan)
+    pval = np.ones(a.shape)
+
+    # TABLES WITH AN EMPTY ROW OR COLUMN HAVE A P-VALUE OF 1 AND NO ODDS RATIO
+    valid = (a+b > 0) & (c+d > 0) & (a+c > 0) & (b+d > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        oddsratio[valid] = np.where((c > 0) & (b > 0), a*d / (c*b), np.inf)[valid]
+
+    a, b, c, d = a[valid], b[valid], c[valid], d[valid]
+    n1 = a + b
+    n = a + c
+    M = n1 + c + d
+    mode = ((n + 1) * (n1 + 1) / (M + 2)).astype(np.int64)
+    pexact = hypergeom.pmf(a, M, n1, n)
+    pmode = hypergeom.pmf(mode, M, n1, n)
+
+    epsilon = 1e-14
+    gamma = 1 + epsilon
+    pvalue = np.ones(a.shape)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        at_mode = np.abs(pexact - pmode) / np.maximum(pexact, pmode) <= epsilon
+
+    # OBSERVED TABLE IS BELOW THE MODE: LOWER TAIL PLUS THE MATCHING PART OF THE UPPER TAIL
+    lower = ~at_mode & (a < mode)
+    if lower.any():
+        idx = np.nonzero(lower)[0]
+        plower = hypergeom.cdf(a[idx], M[idx], n1[idx], n[idx])
+        tail_only = hypergeom.pmf(n[idx], M[idx], n1[idx], n[idx]) > pexact[idx] * gamma
+        guess = batch_binary_search(-1, -pexact[idx] * gamma, mode[idx], n[idx], M[idx], n1[idx], n[idx])
+        pvalue[idx] = np.where(tail_only, plower, plower + hypergeom.sf(guess, M[idx], n1[idx], n[idx]))
+
+    # OBSERVED TABLE IS AT OR ABOVE THE MODE: UPPER TAIL PLUS THE MATCHING PART OF THE LOWER TAIL
+    upper = ~at_mode & ~(a < mode)
+    if upper.any():
+        idx = np.nonzero(upper)[0]
+        pupper = hypergeom.sf(a[idx] - 1, M[idx], n1[idx], n[idx])
+        tail_only = hypergeom.pmf(0, M[idx], n1[idx], n[idx]) > pexact[idx] * gamma
+        guess = batch_binary_search(1, pexact[idx] * gamma, np.zeros(idx.shape, dtype=np.int64), mode[idx], M[idx], n1[idx], n[idx])
+        pvalue[idx] = np.where(tail_only, pupper, pupper + hypergeom.cdf(guess, M[idx], n1[idx], n[idx]))
+
+    pval[valid] = np.minimum(pvalue, 1.0)
+
+    return oddsratio, pval
+
+
+def batch_binary_search(sign, target, lo, hi, M, n1, n):
+    """Vectorized version of the binary search used by scipy.stats.fisher_exact to find
+    the opposite-tail boundary of each hypergeometric distribution. The searched
+    function is sign * pmf(x), which is ascending between lo and hi.
+    Returns:
+        guess = array of x values such that sign * pmf(x) <= target < sign * pmf(x+1)
+    """
+    lo, hi = lo.copy(), hi.copy()
+    guess = np.zeros(lo.shape, dtype=np.int64)
+    found = np.zeros(lo.shape, dtype=bool)
+
+    active = lo < hi
+    while active.any():
+        idx = np.nonzero(active)[0]
+        mid = lo[idx] + (hi[idx] - lo[idx]) // 2
+        midval = sign * hypergeom.pmf(mid, M[idx], n1[idx], n[idx])
+        below = midval < target[idx]
+        above = midval > target[idx]
+        lo[idx[below]] = mid[below] + 1
+        hi[idx[above]] = mid[above] - 1
+        exact = ~below & ~above
+        guess[idx[exact]] = mid[exact]
+        found[idx[exact]] = True
+        active = ~found & (lo < hi)
+
+    remaining = np.nonzero(~found)[0]
+    loval = sign * hypergeom.pmf(lo[remaining], M[remaining], n1[remaining], n[remaining])
+    guess[remaining] = np.where(loval <= target[remaining], lo[remaining], lo[remaining] - 1)
+
+    return guess
+
+
+def nan_to_na(values):
+    """Convert a (proteomes x LCD classes) array of results to nested lists of Python floats,
+    replacing NaN with 'N/A'.
     Returns:
-        df = multi-dimensional dictionary
-                1st dimension ---> proteome as keys, LCD classes as values
-                2nd dimension ---> LCD classes as keys, # of proteins with that type of LCD as values
-                    This dimension also contains "Total Proteins" key and corresponding # of proteins in the proteome as the value.
-        org_to_domain = mapping dictionary with organism ID as keys and corresponding domain of life as values
+        values = list of lists in the same shape as the input array
     """
+    return [['N/A' if x != x else x for x in row] for row in values.tolist()]
     
+
+def get_frequencies(file, cache_dir=None):
+    """Get LCD frequencies for each LCD class and organism as a single integer array.
+    If cache_dir is given, the parsed arrays are saved there as .npy files and reused
+    (memory-mapped) on later runs, as long as the source file is unchanged. The cache
+    is checked by modification time first, and by a SHA-1 hash of the file contents
+    if the modification time differs.
+    Returns:
+        freqs = (proteomes x 401) integer array. Column 0 is the total number of proteins
+                in the proteome, the remaining columns are the # of proteins with each
+                type of LCD, in the same order as aa_strings.
+        proteome_index = mapping dictionary with proteome IDs as keys and row numbers in freqs as values
+        domains = array with the domain of life for each row in freqs
+    """
+
+    if cache_dir is not None:
+        cached = load_cached_frequencies(file, cache_dir)
+        if cached is not None:
+            return cached
+
+    proteomes = []
+    domains = []
     h = open(file)
     header = h.readline()
-    df = {}
-    org_to_domain = {}
-    
     for line in h:
-        items = line.rstrip().split('\t')
-        proteome = items[0]
-        domain = items[2]
-        total_prots = int(items[5])
-        lcd_freqs = [int(x) for x in items[6:]]
-        df[proteome] = df.get(proteome, {})
-        for i, lcd_class in enumerate(aa_strings):
-            df[proteome][lcd_class] = lcd_freqs[i]
-        df[proteome]['Total Proteins'] = total_prots
-        org_to_domain[proteome] = domain
-        
+        items = line.split('\t', 3)
+        proteomes.append(items[0])
+        domains.append(items[2])
     h.close()
-        
-    return df, org_to_domain
+
+    freqs = np.loadtxt(file, delimiter='\t', skiprows=1, usecols=range(5, 6 + len(aa_strings)), dtype=np.int32, ndmin=2)
+    proteomes = np.array(proteomes, dtype=str)
+    domains = np.array(domains, dtype=str)
+
+    if cache_dir is not None:
+        save_cached_frequencies(file, cache_dir, freqs, proteomes, domains)
+
+    proteome_index = {proteome:i for i, proteome in enumerate(proteomes.tolist())}
+
+    return freqs, proteome_index, domains
+
+
+def get_cache_prefix(file, cache_dir):
+    """Get the path prefix shared by all cache files for a given frequency table.
+    Returns:
+        prefix = string path prefix inside cache_dir
+    """
+    return os.path.join(cache_dir, os.path.basename(file))
+
+
+def hash_file(file):
+    """Calculate the SHA-1 hash of a file's contents, reading it in blocks.
+    Returns:
+        digest = hexadecimal hash string
+    """
+    sha1 = hashlib.sha1()
+    h = open(file, 'rb')
+    for block in iter(lambda: h.read(1 << 20), b''):
+        sha1.update(block)
+    h.close()
+
+    return sha1.hexdigest()
+
+
+def load_cached_frequencies(file, cache_dir):
+    """Load cached frequency arrays for a table if the cache matches the current file.
+    Returns:
+        (freqs, proteome_index, domains) as in get_frequencies, or None if there is no valid cache
+    """
+    prefix = get_cache_prefix(file, cache_dir)
+    if not os.path.exists(prefix + '.key.json'):
+        return None
+
+    h = open(prefix + '.key.json')
+    key = json.load(h)
+    h.close()
+
+    mtime = os.path.getmtime(file)
+    if key['mtime'] != mtime:
+        if key['sha1'] != hash_file(file):
+            return None
+        # SAME CONTENTS WITH A NEW TIMESTAMP: RECORD THE NEW TIMESTAMP SO THE HASH IS NOT RECOMPUTED NEXT TIME
+        key['mtime'] = mtime
+        output = open(prefix + '.key.json', 'w')
+        json.dump(key, output)
+        output.close()
+
+    freqs = np.load(prefix + '.freqs.npy', mmap_mode='r')
+    proteomes = np.load(prefix + '.proteomes.npy')
+    domains = np.load(prefix + '.domains.npy')
+    proteome_index = {proteome:i for i, proteome in enumerate(proteomes.tolist())}
+
+    return freqs, proteome_index, domains
+
+
+def save_cached_frequencies(file, cache_dir, freqs, proteomes, domains):
+    """Save parsed frequency arrays for a table, along with the key used to validate them.
+    Returns:
+        None
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix = get_cache_prefix(file, cache_dir)
+    np.save(prefix + '.freqs.npy', freqs)
+    np.save(prefix + '.proteomes.npy', proteomes)
+    np.save(prefix + '.domains.npy', domains)
+
+    # THE KEY IS WRITTEN LAST SO THAT AN INTERRUPTED SAVE IS NEVER MISTAKEN FOR A VALID CACHE
+    output = open(prefix + '.key.json', 'w')
+    json.dump({'mtime':os.path.getmtime(file), 'sha1':hash_file(file)}, output)
+    output.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+
+import matplotlib.pyplot as plt
+import seaborn as sns
+import pandas as pd
+import numpy as np
+from plot_IndividualOrganism_lnORs_and_Pvals import aa_strings, domains, results_file, determine_domain_aa_order
+
+def main():
+
+    significance_threshold = 0.05
+
+    # GATHER lnORs AND CORRECTED P-VALUES FOR ALL PROTEOMES AS (PROTEOMES x 400) ARRAYS
+    proteomes, proteome_domains, lnORs, corrected_pvals = get_all_results(results_file)
+
+    # SUMMARIZE EACH DOMAIN OF LIFE IN ONE PASS PER DOMAIN
+    summary_df = summarize_domains(proteome_domains, lnORs, corrected_pvals, significance_threshold)
+
+    # OUTPUT DOMAIN-LEVEL SUMMARY TABLE
+    output = open('DomainLevel_LCDclass_Summary_lnORs_and_SignificantFractions.tsv', 'w')
+    output.write('\t'.join(['Domain of Life', 'LCD Class', '# of Proteomes', '# of Proteomes with lnOR', 'Median lnOR', 'Mean lnOR', '25th Percentile lnOR', '75th Percentile lnOR', 'Fraction of Proteomes with Statistically Significant Enrichment']) + '\n')
+    for domain in summary_df:
+        stats_df = {stat:summary_df[domain][stat].tolist() for stat in ('# of Proteomes with lnOR', 'Median lnOR', 'Mean lnOR', '25th Percentile lnOR', '75th Percentile lnOR', 'Fraction Significant')}
+        for i, lcd_class in enumerate(aa_strings):
+            output.write('\t'.join([domain, lcd_class, str(summary_df[domain]['# of Proteomes'])] + ['N/A' if stats_df[stat][i] != stats_df[stat][i] else str(stats_df[stat][i]) for stat in stats_df]) + '\n')
+    output.close()
+
+    # MAKE DOMAIN-LEVEL HEATMAPS, WITH AMINO ACIDS SORTED BY THEIR SUMMED FREQUENCY ACROSS THE DOMAIN
+    domain_freqs_df, domain_orders_df = determine_domain_aa_order()
+    for domain in summary_df:
+        ordered_aas = domain_orders_df[domain]
+        median_matrix = make_matrix(summary_df[domain]['Median lnOR'], ordered_aas)
+        fraction_matrix = make_matrix(summary_df[domain]['Fraction Significant'], ordered_aas)
+        plot_domain_heatmap(median_matrix, domain, 'gist_heat', 'Median lnOR', 'MedianlnORvalues')
+        plot_domain_heatmap(fraction_matrix, domain, 'viridis', 'Fraction of Proteomes with\nSignificant Enrichment', 'FractionSignificantlyEnriched')
+
+
+def get_all_results(file):
+    """Gather lnORs and Sidak-Holm corrected p-values for every proteome and LCD class in the
+    Fisher's exact test results file. As in get_data(), the biased lnOR is used whenever the
+    actual lnOR is not available.
+    Returns:
+        proteomes = array of proteome IDs (one per row)
+        proteome_domains = array with the domain of life for each proteome
+        lnORs = (proteomes x 400) array of log odds ratios (NaN when not calculable), columns in aa_strings order
+        corrected_pvals = (proteomes x 400) array of corrected p-values (NaN when not available)
+    """
+
+    df = pd.read_csv(file, sep='\t', usecols=[0, 1, 2, 7, 12, 14], na_values=['N/A'], keep_default_na=False)
+    df.columns = ['Proteome', 'Domain of Life', 'LCD Class', 'lnOR', 'Corrected p-value', 'Biased lnOR']
+
+    proteome_codes, proteomes = pd.factorize(df['Proteome'])
+    class_codes = df['LCD Class'].map({lcd_class:i for i, lcd_class in enumerate(aa_strings)}).to_numpy()
+
+    lnORs = np.full((len(proteomes), len(aa_strings)), np.nan)
+    corrected_pvals = np.full((len(proteomes), len(aa_strings)), np.nan)
+    lnORs[proteome_codes, class_codes] = df['lnOR'].fillna(df['Biased lnOR']).to_numpy(dtype=float)
+    corrected_pvals[proteome_codes, class_codes] = df['Corrected p-value'].to_numpy(dtype=float)
+
+    proteome_domains = np.empty(len(proteomes), dtype=object)
+    proteome_domains[proteome_codes] = df['Domain of Life'].to_numpy()
+
+    return np.asarray(proteomes), proteome_domains, lnORs, corrected_pvals
+
+
+def summarize_domains(proteome_domains, lnORs, corrected_pvals, significance_threshold):
+    """Calculate lnOR distribution statistics and the fraction of proteomes with statistically
+    significant enrichment (corrected p-value below the threshold and lnOR > 0) for every
+    domain of life and LCD class. Each statistic is a single reduction over all proteomes in a domain.
+    Returns:
+        summary_df = multi-dimensional dictionary
+                1st dimension ---> domain of life as keys, statistics as values
+                2nd dimension ---> statistic names as keys, arrays of 400 values (aa_strings order) as values
+    """
+
+    significant = (corrected_pvals < significance_threshold) & (lnORs > 0)
+
+    summary_df = {}
+    for domain in domains:
+        in_domain = proteome_domains == domain
+        num_proteomes = int(in_domain.sum())
+        if num_proteomes == 0:
+            continue
+
+        domain_lnORs = lnORs[in_domain]
+        has_lnOR = ~np.isnan(domain_lnORs)
+        with np.errstate(invalid='ignore'):
+            lnOR_sums = np.where(has_lnOR, domain_lnORs, 0.0).sum(axis=0)
+            lnOR_counts = has_lnOR.sum(axis=0)
+            quartiles = np.full((3, len(aa_strings)), np.nan)
+            calculable = lnOR_counts > 0
+            if calculable.any():
+                quartiles[:, calculable] = np.nanpercentile(domain_lnORs[:, calculable], [25, 50, 75], axis=0)
+
+            summary_df[domain] = {'# of Proteomes':num_proteomes,
+                '# of Proteomes with lnOR':lnOR_counts,
+                'Median lnOR':quartiles[1],
+                'Mean lnOR':lnOR_sums / lnOR_counts,
+                '25th Percentile lnOR':quartiles[0],
+                '75th Percentile lnOR':quartiles[2],
+                'Fraction Significant':significant[in_domain].sum(axis=0) / num_proteomes}
+
+    return summary_df
+
+
+def make_matrix(values, ordered_aas):
+    """Arrange 400 per-class values (aa_strings order) into a heatmap matrix.
+    Returns:
+        df = pandas DataFrame with primary amino acids as columns and secondary amino acids as rows
+    """
+
+    class_index = {lcd_class:i for i, lcd_class in enumerate(aa_strings)}
+    df = {res1:[values[class_index[res1 if res1 == res2 else res1+res2]] for res2 in ordered_aas] for res1 in ordered_aas}
+    df = pd.DataFrame.from_dict(df)
+    df['Secondary Amino Acid'] = list(ordered_aas)
+    df.set_index('Secondary Amino Acid', inplace=True)
+
+    return df
+
+
+def plot_domain_heatmap(df, domain, palette, colorbar_label, file_label):
+    """Plot domain-level heatmap for each LCD class.
+    Returns:
+        None
+    """
+
+    pal = sns.color_palette(palette, as_cmap=True)
+
+    cg = sns.heatmap(df, cmap=pal, cbar_kws={'label':colorbar_label})
+    ax = plt.gca()
+    ax.set_facecolor("grey")
+
+    plt.xticks(rotation=0, fontname='Arial', fontsize=10)
+    plt.yticks(rotation=0, fontname='Arial', fontsize=10)
+    plt.xlabel('Primary Amino Acid', fontname='Arial', fontsize=12)
+    plt.ylabel('Secondary Amino Acid', fontname='Arial', fontsize=12)
+    plt.title(domain, fontname='Arial', fontsize=12)
+
+    plt.ylim(20, 0)
+    plt.savefig(domain + '_Original-vs-Scrambled-Proteomes_DomainLevel_Heatmap_' + file_label + '.tif', bbox_inches='tight', dpi=600, pil_kwargs={'compression':'tiff_lzw'})
+    plt.close()
+
+
+if __name__ == '__main__':
+    main()
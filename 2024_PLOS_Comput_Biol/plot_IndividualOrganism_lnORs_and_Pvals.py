@@ -1,8 +1,16 @@
 
+import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.colors import ListedColormap
 import seaborn as sns
 import pandas as pd
 import math
+import numpy as np
+import multiprocessing
+import functools
+import json
+import os
+from compare_Observed_vs_Scrambled_Frequencies import hash_file
 
 # CREATE LIST OF STRINGS FOR ALL 400 LCD CLASSES
 amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
@@ -16,6 +24,8 @@ for res1 in amino_acids:
 # PREP GLOBAL VARIABLES AND FILE NAMES
 domains = ['Archaea','Bacteria','Eukaryota','Viruses']
 proteomes_of_interest = ['UP000005640_9606', 'UP000001450_36329']
+results_file = 'Observed_vs_Scrambled_FisherExact_Results.tsv'
+background_file = 'Background_AAfrequencies_AllProteomes.tsv'
 fig_labels = {('UP000001450_36329', 'lnOR'):'Fig5A',
             ('UP000001450_36329', 'Statistical Significance'):'Fig5B',
             ('UP000005640_9606', 'lnOR'):'Fig5C',
@@ -25,9 +35,16 @@ fig_labels = {('UP000001450_36329', 'lnOR'):'Fig5A',
 def main():
 
     domain = 'Eukaryota'
+
+    # SET batch_mode TO True TO RENDER lnOR AND STATISTICAL SIGNIFICANCE HEATMAPS FOR EVERY PROTEOME IN THE RESULTS FILE
+    batch_mode = False
+    num_workers = 1
+    if batch_mode:
+        render_atlas(num_workers)
+        return
     
     # SORTED AMINO ACID ORDERS FOR PLOTTING FROM HIGHEST WHOLE-PROTEOME FREQUENCY TO LOWEST WHOLE-PROTEOME FREQUENCY
-    aa_freqs_df, ordered_aas_df = determine_aa_order()
+    aa_freqs_df, ordered_aas_df = determine_aa_order(proteomes_of_interest)
 
     # LOOP OVER PROTEOMES OF INTEREST TO CREATE SEPARATE PLOTS
     for proteome_of_interest in proteomes_of_interest:
@@ -123,8 +140,10 @@ def get_binary_statistical_significance(df):
     return binary_df
     
 
-def get_data(proteome_of_interest):
+def get_data(proteome_of_interest, exit_on_error=True):
     """Gather data from Fisher's exact test results file.
+    If exit_on_error is False, None is returned (instead of exiting) for organisms whose
+    log odds could not be calculated.
     Returns:
         df = multi-dimensional dictionary
                 1st dimension ---> domain of life as keys, LCD classes as values
@@ -136,14 +155,12 @@ def get_data(proteome_of_interest):
         lcd_class_list = list of LCD classes in the same order as pvals_list
     """
     
-    h = open('Observed_vs_Scrambled_FisherExact_Results.tsv')
-    header = h.readline()
     df = {domain:{lcd_class:[] for lcd_class in aa_strings} for domain in domains}
     lnOR_df = {}
     pvals_list = []
     lcd_class_list = []
     
-    for line in h:
+    for line in read_proteome_lines(results_file, proteome_of_interest):
         items = line.rstrip().split('\t')
         proteome = items[0]
         if proteome != proteome_of_interest:
@@ -159,6 +176,8 @@ def get_data(proteome_of_interest):
         lnOR = items[7]
         if lnOR == 'N/A':
             if items[14] == 'N/A':
+                if not exit_on_error:
+                    return None
                 print('\nSome log odds were not calculable even with biased estimates. Analysis could not be completed for this organism. This only occurs when all of the proteins in a proteome contain an LCD of one type, and is believed to occur only for small viruses with a total of 1-2 proteins in the proteome. Exiting program.\n')
                 exit()
             lnOR = float(items[14])     # USE BIASED lnOR IF THE ACTUAL lnOR IS NOT AVAILABLE
@@ -174,10 +193,60 @@ def get_data(proteome_of_interest):
         df[domain][lcd_class].append(pval)
         pvals_list.append(pval)
         lcd_class_list.append(lcd_class)
-        
-    h.close()
     
     return df, lnOR_df, pvals_list, lcd_class_list
+
+
+def read_proteome_lines(file, proteome_of_interest):
+    """Read the lines of the Fisher's exact test results file for one proteome.
+    If the index sidecar written by compare_Observed_vs_Scrambled_Frequencies.py is available,
+    this seeks directly to the proteome's block of rows. Otherwise (or if the index is out of
+    date) the whole file is scanned.
+    Returns:
+        lines = list of lines (strings) belonging to proteome_of_interest
+    """
+
+    index = load_results_index(file)
+    if proteome_of_interest in index:
+        offset, length = index[proteome_of_interest]
+        h = open(file, 'rb')
+        h.seek(offset)
+        block = h.read(length).decode()
+        h.close()
+        lines = block.splitlines(keepends=True)
+
+        # ONLY TRUST THE INDEX IF IT POINTS TO ALL 400 COMPLETE LINES FOR THE PROTEOME OF INTEREST
+        if block.endswith('\n') and len(lines) == len(aa_strings) and all(line.startswith(proteome_of_interest + '\t') for line in lines):
+            return lines
+
+    h = open(file)
+    header = h.readline()
+    lines = [line for line in h if line.split('\t', 1)[0] == proteome_of_interest]
+    h.close()
+
+    return lines
+
+
+@functools.lru_cache(maxsize=None)
+def load_results_index(file):
+    """Load the index sidecar (<file>.idx) for the Fisher's exact test results file.
+    Returns:
+        index = dictionary with proteome IDs as keys and (byte offset, byte length) tuples as values.
+                Empty if no index file exists.
+    """
+
+    index = {}
+    if not os.path.exists(file + '.idx'):
+        return index
+
+    h = open(file + '.idx')
+    header = h.readline()
+    for line in h:
+        proteome, offset, length = line.rstrip('\n').split('\t')[:3]
+        index[proteome] = (int(offset), int(length))
+    h.close()
+
+    return index
     
 
 def plot_heatmap(df, proteome_of_interest, fig_label):
@@ -230,31 +299,305 @@ def plot_binary_heatmap(df, proteome_of_interest, fig_label):
     plt.savefig(fig_label + '_' + proteome_of_interest + '_Original-vs-Scrambled-Proteome_Heatmap_Pvalues_BinaryStatSigClassification.tif', bbox_inches='tight', dpi=600, pil_kwargs={'compression':'tiff_lzw'})
     plt.close()
     
+
+def render_atlas(num_workers, atlas_dir='Heatmap_Atlas', dpi=200, proteomes_per_chunk=50):
+    """Render lnOR and binary statistical significance heatmaps for every proteome in the
+    Fisher's exact test results file. Proteomes are split into chunks that are rendered by a
+    pool of worker processes, each of which reuses one figure template per heatmap type.
+    Returns:
+        None
+    """
+
+    os.makedirs(atlas_dir, exist_ok=True)
+
+    proteomes = list(load_results_index(results_file))
+    if len(proteomes) == 0:
+        h = open(results_file)
+        header = h.readline()
+        for line in h:
+            proteome = line.split('\t', 1)[0]
+            if len(proteomes) == 0 or proteomes[-1] != proteome:
+                proteomes.append(proteome)
+        h.close()
+
+    aa_freqs_df, ordered_aas_df = determine_aa_order(proteomes)
+    jobs = [(proteome, ordered_aas_df[proteome]) for proteome in proteomes if proteome in ordered_aas_df]
+    chunks = [(jobs[i:i+proteomes_per_chunk], atlas_dir, dpi) for i in range(0, len(jobs), proteomes_per_chunk)]
+
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            skipped = pool.map(render_heatmap_chunk, chunks, chunksize=1)
+    else:
+        skipped = [render_heatmap_chunk(chunk) for chunk in chunks]
+
+    skipped = [proteome for chunk_skipped in skipped for proteome in chunk_skipped]
+    if len(skipped) > 0:
+        print('\nSkipped ' + str(len(skipped)) + ' proteome(s) with log odds that were not calculable even with biased estimates: ' + ', '.join(skipped) + '\n')
+
+
+def render_heatmap_chunk(chunk):
+    """Render heatmaps for one chunk of proteomes using the non-interactive Agg backend.
+    The figures, axes and colorbars are created once, and only the cell values, color
+    limits and tick labels are updated for each proteome.
+    Returns:
+        skipped = list of proteome IDs that could not be plotted
+    """
+
+    jobs, atlas_dir, dpi = chunk
+    matplotlib.use('Agg')
+    lnOR_template = make_heatmap_template(sns.color_palette('gist_heat', as_cmap=True), 'grey')
+    binary_template = make_heatmap_template(ListedColormap(['grey', 'black', 'red']), 'white')
+    binary_template[2].set_clim(1, 3)
+
+    skipped = []
+    for proteome_of_interest, ordered_aas in jobs:
+        matrices = get_heatmap_matrices(proteome_of_interest, ordered_aas)
+        if matrices is None:
+            skipped.append(proteome_of_interest)
+            continue
+        lnOR_matrix, binary_matrix = matrices
+
+        update_heatmap_template(lnOR_template, lnOR_matrix, ordered_aas, np.nanmin(lnOR_matrix), np.nanmax(lnOR_matrix))
+        lnOR_template[0].savefig(os.path.join(atlas_dir, proteome_of_interest + '_Original-vs-Scrambled-Proteome_Heatmap_lnORvalues.png'), bbox_inches='tight', dpi=dpi)
+
+        update_heatmap_template(binary_template, binary_matrix, ordered_aas)
+        binary_template[0].savefig(os.path.join(atlas_dir, proteome_of_interest + '_Original-vs-Scrambled-Proteome_Heatmap_Pvalues_BinaryStatSigClassification.png'), bbox_inches='tight', dpi=dpi)
+
+    plt.close(lnOR_template[0])
+    plt.close(binary_template[0])
+
+    return skipped
+
+
+def make_heatmap_template(cmap, facecolor):
+    """Create a reusable 20x20 heatmap figure styled like plot_heatmap() and plot_binary_heatmap().
+    Returns:
+        template = tuple of (figure, axes, QuadMesh of heatmap cells)
+    """
+
+    fig, ax = plt.subplots()
+    mesh = ax.pcolormesh(np.ma.masked_invalid(np.zeros((20, 20))), cmap=cmap)
+    ax.set_facecolor(facecolor)
+    cb = fig.colorbar(mesh, ax=ax)
+    cb.ax.tick_params(labelsize=10)
+
+    ticks = [x + 0.5 for x in range(20)]
+    ax.set_xticks(ticks)
+    ax.set_yticks(ticks)
+    ax.tick_params(labelsize=10)
+    ax.set_xlabel('Primary Amino Acid', fontname='Arial', fontsize=12)
+    ax.set_ylabel('Secondary Amino Acid', fontname='Arial', fontsize=12)
+    ax.set_ylim(20, 0)
+
+    return fig, ax, mesh
+
+
+def update_heatmap_template(template, matrix, ordered_aas, vmin=None, vmax=None):
+    """Swap a new matrix and amino acid order into a heatmap template.
+    Returns:
+        None
+    """
+
+    fig, ax, mesh = template
+    mesh.set_array(np.ma.masked_invalid(matrix))
+    if vmin is not None:
+        mesh.set_clim(vmin, vmax)
+    ax.set_xticklabels(ordered_aas, rotation=0, fontname='Arial')
+    ax.set_yticklabels(ordered_aas, rotation=0, fontname='Arial')
+
+
+def get_heatmap_matrices(proteome_of_interest, ordered_aas):
+    """Build the lnOR and binary statistical significance matrices for one proteome.
+    Rows are secondary amino acids and columns are primary amino acids, both in ordered_aas order,
+    matching the tables written by main().
+    Returns:
+        lnOR_matrix = 20x20 array of log odds ratios
+        binary_matrix = 20x20 array of label-encoded statistical significance (see get_binary_statistical_significance)
+        (or None if the log odds were not calculable for this proteome)
+    """
+
+    data = get_data(proteome_of_interest, exit_on_error=False)
+    if data is None:
+        return None
+    pvals_df, lnOR_df, pvals_list, lcd_class_list = data
+    corrected_pvals_df = {lcd_class:pvals_list[i] for i, lcd_class in enumerate(lcd_class_list)}
+
+    lnOR_matrix = np.zeros((20, 20))
+    binary_matrix = np.zeros((20, 20))
+    for col, res1 in enumerate(ordered_aas):
+        for row, res2 in enumerate(ordered_aas):
+            lcd_class = res1 if res1 == res2 else res1+res2
+            lnOR_matrix[row, col] = lnOR_df[proteome_of_interest][lcd_class]
+            corrected_pval = corrected_pvals_df[lcd_class]
+            if corrected_pval == 'N/A':
+                binary_matrix[row, col] = 1    # MASKED VALUE: NO LCDs
+            elif corrected_pval < 0.05:
+                binary_matrix[row, col] = 3
+            else:
+                binary_matrix[row, col] = 2
+
+    return lnOR_matrix, binary_matrix
+
+
     
-def determine_aa_order():
+def determine_aa_order(proteomes=None):
     """Determines amino acid order for each organism to use in the heatmap axis ticks.
     This sorts amino acids from most frequent in the proteome to least frequent in the proteome.
+    The background frequency table is parsed and sorted only once (see load_background_frequencies),
+    so repeated calls only look up the requested proteomes.
     Returns:
         df = dictionary with proteome IDs as keys, list of whole-proteome amino acid frequencies as values (alphabetical order by single-letter abbreviation)
         aa_orders_df = dictionary with proteome IDs as keys, list of amino acids sorted from most frequent to least frequent
+        Both dictionaries are limited to the requested proteomes, or include all proteomes if proteomes is None.
     """
     
-    h = open('Background_AAfrequencies_AllProteomes.tsv')
-    header = h.readline()
+    freqs, orders, proteome_index, proteome_domains = load_background_frequencies(background_file)
+    if proteomes is None:
+        proteomes = proteome_index.keys()
+
     df = {}
     aa_orders_df = {}
-    for line in h:
-        domain, proteome, *aa_freqs = line.rstrip().split('\t')
-        aa_freqs = [int(x) for x in aa_freqs]
-        df[proteome] = aa_freqs
-        
-        aas = list(amino_acids)
-        aa_freqs, aas = zip(*sorted(zip(aa_freqs, aas), reverse=True))
-        aa_orders_df[proteome] = aas
-        
-    h.close()
+    for proteome in proteomes:
+        if proteome not in proteome_index:
+            continue
+        row = proteome_index[proteome]
+        df[proteome] = freqs[row].tolist()
+        aa_orders_df[proteome] = tuple(amino_acids[i] for i in orders[row])
     
     return df, aa_orders_df
+
+
+def determine_domain_aa_order():
+    """Determines amino acid order for each domain of life, based on the amino acid frequencies
+    summed over all proteomes in that domain.
+    Returns:
+        df = dictionary with domains as keys, list of summed amino acid frequencies as values (alphabetical order by single-letter abbreviation)
+        aa_orders_df = dictionary with domains as keys, list of amino acids sorted from most frequent to least frequent
+    """
+
+    freqs, orders, proteome_index, proteome_domains = load_background_frequencies(background_file)
+    domain_labels, domain_rows = np.unique(proteome_domains, return_inverse=True)
+    domain_freqs = np.zeros((len(domain_labels), len(amino_acids)), dtype=np.int64)
+    np.add.at(domain_freqs, domain_rows, freqs)
+    domain_orders = sort_aa_frequencies(domain_freqs)
+
+    df = {}
+    aa_orders_df = {}
+    for i, domain in enumerate(domain_labels.tolist()):
+        df[domain] = domain_freqs[i].tolist()
+        aa_orders_df[domain] = tuple(amino_acids[j] for j in domain_orders[i])
+
+    return df, aa_orders_df
+
+
+@functools.lru_cache(maxsize=None)
+def load_background_frequencies(file):
+    """Parse the whole-proteome amino acid frequency table once and sort every proteome's
+    amino acids by frequency in a single vectorized pass. The arrays are saved as .npy files
+    next to the table and reused by later runs (and by every atlas worker process) as long as
+    the table is unchanged, checked the same way as the LCD frequency cache in
+    compare_Observed_vs_Scrambled_Frequencies.py. Within a process, later calls reuse the cached arrays.
+    Returns:
+        freqs = (proteomes x 20) integer array of amino acid frequencies (alphabetical order by single-letter abbreviation)
+        orders = (proteomes x 20) array of column indices into amino_acids, sorted from most frequent to least frequent
+        proteome_index = dictionary with proteome IDs as keys and row numbers as values
+        proteome_domains = array with the domain of life for each row
+    """
+
+    cached = load_cached_background_frequencies(file)
+    if cached is not None:
+        return cached
+
+    proteome_domains = []
+    proteomes = []
+    h = open(file)
+    header = h.readline()
+    for line in h:
+        domain, proteome, junk = line.split('\t', 2)
+        proteome_domains.append(domain)
+        proteomes.append(proteome)
+    h.close()
+
+    freqs = np.loadtxt(file, delimiter='\t', skiprows=1, usecols=range(2, 2 + len(amino_acids)), dtype=np.int64, ndmin=2)
+    orders = sort_aa_frequencies(freqs)
+    proteomes = np.array(proteomes, dtype=str)
+    proteome_domains = np.array(proteome_domains, dtype=str)
+    save_cached_background_frequencies(file, freqs, orders, proteomes, proteome_domains)
+
+    proteome_index = {proteome:i for i, proteome in enumerate(proteomes.tolist())}
+
+    return freqs, orders, proteome_index, proteome_domains
+
+
+def load_cached_background_frequencies(file):
+    """Load the cached background frequency arrays if the cache matches the current table. The cache is
+    checked by modification time first, and by a SHA-1 hash of the table if the modification time differs.
+    Returns:
+        (freqs, orders, proteome_index, proteome_domains) as in load_background_frequencies, or None if there is no valid cache
+    """
+    prefix = file + '.cache'
+    if not os.path.exists(prefix + '.key.json'):
+        return None
+
+    h = open(prefix + '.key.json')
+    key = json.load(h)
+    h.close()
+
+    mtime = os.path.getmtime(file)
+    if key['mtime'] != mtime:
+        if key['sha1'] != hash_file(file):
+            return None
+        # SAME CONTENTS WITH A NEW TIMESTAMP: RECORD THE NEW TIMESTAMP SO THE HASH IS NOT RECOMPUTED NEXT TIME
+        key['mtime'] = mtime
+        write_cache_file(prefix + '.key.json', lambda handle: handle.write(json.dumps(key).encode()))
+
+    freqs = np.load(prefix + '.freqs.npy')
+    orders = np.load(prefix + '.orders.npy')
+    proteomes = np.load(prefix + '.proteomes.npy')
+    proteome_domains = np.load(prefix + '.domains.npy')
+    proteome_index = {proteome:i for i, proteome in enumerate(proteomes.tolist())}
+
+    return freqs, orders, proteome_index, proteome_domains
+
+
+def save_cached_background_frequencies(file, freqs, orders, proteomes, proteome_domains):
+    """Save the background frequency arrays next to the table, along with the key used to validate them.
+    Returns:
+        None
+    """
+    prefix = file + '.cache'
+    for suffix, array in (('.freqs.npy', freqs), ('.orders.npy', orders), ('.proteomes.npy', proteomes), ('.domains.npy', proteome_domains)):
+        write_cache_file(prefix + suffix, lambda handle: np.save(handle, array))
+
+    # THE KEY IS WRITTEN LAST SO THAT AN INTERRUPTED SAVE IS NEVER MISTAKEN FOR A VALID CACHE
+    key = {'mtime':os.path.getmtime(file), 'sha1':hash_file(file)}
+    write_cache_file(prefix + '.key.json', lambda handle: handle.write(json.dumps(key).encode()))
+
+
+def write_cache_file(path, write):
+    """Write a cache file under a temporary name and move it into place, so that processes reading
+    the cache at the same time never see a partially written file.
+    Returns:
+        None
+    """
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    handle = open(tmp_path, 'wb')
+    write(handle)
+    handle.close()
+    os.replace(tmp_path, path)
+
+
+def sort_aa_frequencies(freqs):
+    """Sort amino acids in each row of a frequency array from most frequent to least frequent.
+    Ties are broken in reverse alphabetical order, matching sorted(zip(freqs, aas), reverse=True).
+    Returns:
+        orders = array of column indices into amino_acids, same shape as freqs
+    """
+
+    tiebreak = np.broadcast_to(-np.arange(freqs.shape[1]), freqs.shape)
+
+    return np.lexsort((tiebreak, -freqs), axis=-1)
+
         
 if __name__ == '__main__':
     main()
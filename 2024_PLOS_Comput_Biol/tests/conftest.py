@@ -0,0 +1,6 @@
+
+import os
+import sys
+
+# THE ANALYSIS SCRIPTS ARE STANDALONE MODULES IN THE PARENT DIRECTORY
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
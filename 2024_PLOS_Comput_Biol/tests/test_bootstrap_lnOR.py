@@ -0,0 +1,34 @@
+
+import numpy as np
+import pytest
+from compare_Observed_vs_Scrambled_Frequencies import bootstrap_lnOR, calc_lnOR
+
+# (# IN ACTUAL PROTEOME, TOTAL PROTEINS, # IN SCRAMBLED PROTEOME, TOTAL PROTEINS). THE FIRST TWO ARE THE K CLASS FOR MALARIA AND HUMANS
+known_tables = [(2031, 5374, 945, 5374),
+    (942, 20541, 27, 20541),
+    (300, 5000, 200, 5100),
+    (1000, 20000, 1500, 20000)]
+
+
+def run_bootstrap(tables, n_resamples=4000, seed=0):
+    obs, total_obs, scr, total_scr = [np.array([[table[i] for table in tables]]) for i in range(4)]
+
+    return bootstrap_lnOR(obs, total_obs, scr, total_scr, n_resamples, np.random.default_rng(seed), 1 << 28)
+
+
+@pytest.mark.parametrize('table', known_tables)
+def test_bootstrap_median_matches_point_estimate(table):
+    lnOR = calc_lnOR(*[np.array([x]) for x in table])[1][0]
+    medians, lower_CI, upper_CI = [x[0, 0] for x in run_bootstrap([table])]
+
+    assert medians == pytest.approx(lnOR, abs=0.05)
+    assert lower_CI < lnOR < upper_CI
+
+
+@pytest.mark.parametrize('table', [(0, 5000, 0, 5000), (0, 5000, 7, 5000), (7, 5000, 0, 5000), (5000, 5000, 4990, 5000)])
+def test_bootstrap_zero_cells_have_nonzero_width(table):
+    medians, lower_CI, upper_CI = [x[0, 0] for x in run_bootstrap([table])]
+
+    assert np.isfinite([medians, lower_CI, upper_CI]).all()
+    assert lower_CI < upper_CI
+    assert lower_CI <= medians <= upper_CI
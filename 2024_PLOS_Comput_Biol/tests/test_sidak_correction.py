@@ -0,0 +1,75 @@
+
+import numpy as np
+import mpmath
+import pytest
+import os
+from compare_Observed_vs_Scrambled_Frequencies import sidak_correction, format_pval, output_columns
+
+results_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Observed_vs_Scrambled_FisherExact_Results.tsv')
+
+
+def mpmath_sidak_correction(pvals, dps=400):
+    """Sidak-Holm correction as originally implemented with mpmath. The original 300 digits are not enough to
+    represent 1-p for p below ~1e-284 (subnormal p-values came out as 0), so the reference uses 400 digits."""
+    mpmath.mp.dps = dps
+    sorted_pvals, positions = zip(*sorted(zip(pvals, range(len(pvals)))))
+    m = len(pvals)
+
+    corrected_pvals = [1 - (1 - mpmath.mpf(sorted_pvals[m - k])) ** k for k in range(m, 0, -1)]
+    for i in range(1, m):
+        corrected_pvals[i] = max(corrected_pvals[i - 1], corrected_pvals[i])
+
+    final_pvals = [0.0] * m
+    for position, corrected_pval in zip(positions, corrected_pvals):
+        final_pvals[position] = float(corrected_pval)
+
+    return final_pvals
+
+
+edge_cases = {'zeros':[0.0, 0.0, 0.5, 1e-300],
+    'subnormal':[5e-324, 1e-320, 2.5e-310, 1e-308, 0.01],
+    'near one':[1 - 1e-16, 0.999999, 1.0, 0.5, 1e-3],
+    'ties':[1e-10, 1e-10, 1e-10, 0.2, 0.2, 5e-324, 5e-324],
+    'single':[0.03]}
+
+
+@pytest.mark.parametrize('name', edge_cases)
+def test_sidak_correction_matches_mpmath_edge_cases(name):
+    np.testing.assert_allclose(sidak_correction(edge_cases[name]), mpmath_sidak_correction(edge_cases[name]), rtol=1e-13, atol=0)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_sidak_correction_matches_mpmath_400_classes(seed):
+    rng = np.random.default_rng(seed)
+    pvals = (10.0 ** -rng.uniform(0, 330, size=400)).tolist()      # LOG-UNIFORM, INCLUDING SUBNORMALS AND UNDERFLOWED ZEROS
+    pvals[:20] = [pvals[20]] * 20                                   # TIES
+    pvals[-5:] = [1.0, 1 - 1e-16, 0.0, 5e-324, 0.5]
+
+    np.testing.assert_allclose(sidak_correction(pvals), mpmath_sidak_correction(pvals), rtol=1e-13, atol=0)
+
+
+def test_format_pval_matches_mpmath_nstr():
+    rng = np.random.default_rng(0)
+    pvals = [0.0, 1.0, 0.5, 0.1, 1e-5, 1.2e-5, 9.99e-5, 1e-4, 1 - 1e-16, 5e-324] + (10.0 ** -rng.uniform(0, 320, size=20000)).tolist()
+
+    assert [format_pval(pval) for pval in pvals] == [mpmath.nstr(mpmath.mpf(pval), 16) for pval in pvals]
+
+
+@pytest.mark.skipif(np.finfo(np.longdouble).precision <= np.finfo(float).precision, reason='np.longdouble is double precision on this platform')
+def test_sidak_correction_reproduces_shipped_results():
+    pval_col = output_columns.index('p-value')
+    corrected_col = output_columns.index('Sidak-Holm Corrected p-value')
+
+    proteome_rows = {}
+    h = open(results_file)
+    header = h.readline()
+    for line in h:
+        items = line.rstrip('\n').split('\t')
+        if items[pval_col] != 'N/A':
+            proteome_rows.setdefault(items[0], []).append(items)
+    h.close()
+
+    assert proteome_rows
+    for proteome, rows in proteome_rows.items():
+        corrected_pvals = sidak_correction([float(items[pval_col]) for items in rows])
+        assert [format_pval(pval) for pval in corrected_pvals] == [items[corrected_col] for items in rows]